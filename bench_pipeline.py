@@ -0,0 +1,304 @@
+"""main.py の音声処理パイプラインのオフラインベンチマーク。
+
+合成した録音セグメント（既定: 5分, 44.1kHz）に対して各処理段階を繰り返し実行し、
+処理速度（実時間比・MB/s）、レイテンシのパーセンタイル、段階ごとのピークRSSを表示する。
+アップロード経路は Worker API と R2 を模したローカルHTTPサーバに対して計測する。
+
+    python bench_pipeline.py
+    python bench_pipeline.py --stages filter,encode --iterations 10
+    python bench_pipeline.py --latency-ms 80 --bandwidth-mbps 10   # 遅い回線を模擬
+    python bench_pipeline.py --json result.json                     # 結果を保存
+    python bench_pipeline.py --baseline result.json --tolerance 0.2  # 20%以上遅くなったら終了コード1
+
+各段階は別プロセスで実行するため、ピークRSSはその段階だけの値になる。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import types
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+STAGES = ["filter", "vad", "encode", "encode_wav", "upload", "pipeline"]
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _import_main(workdir: str):
+    """main.py を読み込む。マイクや local_settings.py が無い環境でもベンチマークできるよう仮の設定と pyaudio を入れる。"""
+    os.chdir(workdir)  # processing.log などは作業ディレクトリに出力させる
+    sys.path.insert(0, ROOT)
+    try:
+        import pyaudio  # noqa: F401
+    except ImportError:
+        fake = types.ModuleType("pyaudio")
+        fake.paInt16 = 8
+        sys.modules["pyaudio"] = fake
+    try:
+        import local_settings  # noqa: F401
+    except ImportError:
+        settings = types.ModuleType("local_settings")
+        settings.FOLDER_PATH = os.path.join(workdir, "archive")
+        settings.GROUP_ID = "BENCH"
+        sys.modules["local_settings"] = settings
+    import main
+    return main
+
+
+def synthesize_segment(path: str, seconds: float, rate: int, seed: int = 0) -> None:
+    """発話と無音が交互に続くような合成音声を WAV に書き出す。"""
+    rng = np.random.default_rng(seed)
+    with wave.open(path, "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(rate)
+        block = rate  # 1秒ずつ生成
+        for i in range(int(np.ceil(seconds))):
+            n = min(block, int(seconds * rate) - i * block)
+            t = (np.arange(n) + i * block) / rate
+            noise = rng.normal(0, 20, n)
+            if rng.random() < 0.7:
+                # 基本周波数が揺らぐ倍音＋包絡で声らしくする
+                f0 = 120 + 40 * np.sin(2 * np.pi * 0.3 * t)
+                phase = 2 * np.pi * np.cumsum(f0) / rate
+                voice = sum(np.sin(k * phase) / k for k in range(1, 12))
+                envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 3 * t) ** 2
+                noise += 3000 * voice * envelope
+            out.writeframes(np.clip(noise, -32768, 32767).astype("<i2").tobytes())
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """Worker API（署名URL発行・処理依頼）と R2（PUT）の代わりをするハンドラ。"""
+
+    latency = 0.0
+    bandwidth = 0.0  # bytes/s（0 で無制限）
+    counter = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> int:
+        length = int(self.headers.get("Content-Length") or 0)
+        remaining = length
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 1 << 16))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+        if self.bandwidth:
+            time.sleep(length / self.bandwidth)
+        return length
+
+    def _reply(self, body: dict) -> None:
+        data = json.dumps(body).encode()
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self._read_body()
+        if self.path == "/api/generate-upload-url":
+            with self.lock:
+                _StandInHandler.counter += 1
+                key = f"bench/{_StandInHandler.counter}"
+            self._reply({"uploadUrl": f"http://{self.headers['Host']}/r2/{key}", "objectKey": key})
+        elif self.path == "/api/process-request":
+            self._reply({"jobId": "bench"})
+        else:
+            self.send_error(404)
+
+    def do_PUT(self):
+        self._read_body()
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def start_stand_in(latency: float, bandwidth: float) -> ThreadingHTTPServer:
+    _StandInHandler.latency = latency
+    _StandInHandler.bandwidth = bandwidth
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _run_stage(stage: str, segment: str, args, result_queue) -> None:
+    """1つの段階を別プロセスで繰り返し実行し、計測結果を返す。"""
+    try:
+        _measure_stage(stage, segment, args, result_queue)
+    except Exception as e:
+        result_queue.put({"stage": stage, "error": f"{type(e).__name__}: {e}"})
+
+
+def _measure_stage(stage: str, segment: str, args, result_queue) -> None:
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    main = _import_main(workdir)
+    server = client = None
+    samples = fs = audio = content_type = None
+
+    # 段階の入力を準備（計測対象外）
+    if stage in ("vad", "encode", "encode_wav", "upload"):
+        samples, fs = main.filter_segment(segment)
+    if stage == "upload":
+        audio, content_type, _ = main.encode_audio(samples, fs)
+        samples = None
+    if stage in ("upload", "pipeline"):
+        server = start_stand_in(args.latency_ms / 1000, args.bandwidth_mbps * 125_000)
+        client = main.WorkerApiClient(base_url=f"http://127.0.0.1:{server.server_port}", prefetch=0)
+
+    def once():
+        if stage == "filter":
+            return main.filter_segment(segment)[0].nbytes
+        if stage == "vad":
+            main.detect_speech(samples, fs)
+            return samples.nbytes
+        if stage == "encode":
+            return len(main.encode_audio(samples, fs)[0])
+        if stage == "encode_wav":
+            return len(main._encode_wav(main._iter_blocks(samples), fs, 1))
+        if stage == "upload":
+            upload_url, object_key = client.get_signed_upload_url(content_type)
+            client.upload_to_r2(upload_url, audio, content_type)
+            client.request_transcription(object_key, "bench-session", "BENCH")
+            return len(audio)
+        if stage == "pipeline":
+            data, fs_ = main.filter_segment(segment)
+            activity = main.detect_speech(data, fs_)
+            data = data[activity.start:activity.end]
+            encoded, ctype, _ = main.encode_audio(data, fs_)
+            upload_url, object_key = client.get_signed_upload_url(ctype)
+            client.upload_to_r2(upload_url, encoded, ctype)
+            client.request_transcription(object_key, "bench-session", "BENCH", activity.metadata())
+            return len(encoded)
+        raise ValueError(stage)
+
+    rss_before = _peak_rss_mb()
+    latencies, sizes = [], []
+    for _ in range(args.warmup):
+        once()
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        sizes.append(once())
+        latencies.append(time.perf_counter() - start)
+    rss_after = _peak_rss_mb()
+
+    if server is not None:
+        server.shutdown()
+    result_queue.put({
+        "stage": stage,
+        "latencies": latencies,
+        "bytes": float(np.mean(sizes)),
+        "peak_rss_mb": rss_after,
+        "stage_rss_mb": max(0.0, rss_after - rss_before),
+    })
+
+
+def summarize(result: dict, audio_seconds: float) -> dict:
+    lat = np.array(result["latencies"])
+    return {
+        "stage": result["stage"],
+        "iterations": len(lat),
+        "p50": float(np.percentile(lat, 50)),
+        "p90": float(np.percentile(lat, 90)),
+        "p99": float(np.percentile(lat, 99)),
+        "max": float(lat.max()),
+        "realtime_x": audio_seconds / float(np.median(lat)),
+        "mb_per_s": result["bytes"] / float(np.median(lat)) / 1e6,
+        "output_bytes": result["bytes"],
+        "peak_rss_mb": result["peak_rss_mb"],
+        "stage_rss_mb": result["stage_rss_mb"],
+    }
+
+
+def print_table(rows: list) -> None:
+    header = f"{'stage':<11}{'n':>4}{'p50[s]':>9}{'p90[s]':>9}{'p99[s]':>9}{'x実時間':>10}{'MB/s':>9}{'出力MB':>9}{'RSS[MB]':>9}{'+段階':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(f"{r['stage']:<11}{r['iterations']:>4}{r['p50']:>9.3f}{r['p90']:>9.3f}{r['p99']:>9.3f}"
+              f"{r['realtime_x']:>10.1f}{r['mb_per_s']:>9.2f}{r['output_bytes'] / 1e6:>9.2f}"
+              f"{r['peak_rss_mb']:>9.1f}{r['stage_rss_mb']:>8.1f}")
+
+
+def compare_with_baseline(rows: list, baseline_path: str, tolerance: float) -> list:
+    """ベースラインより p50 が tolerance を超えて遅くなった段階を返す。"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {r["stage"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for r in rows:
+        base = baseline.get(r["stage"])
+        if base and r["p50"] > base["p50"] * (1 + tolerance):
+            regressions.append(f"{r['stage']}: p50 {base['p50']:.3f}s -> {r['p50']:.3f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="音声処理パイプラインのオフラインベンチマーク")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"計測する段階（カンマ区切り）: {', '.join(STAGES)}")
+    parser.add_argument("--seconds", type=float, default=300.0, help="合成するセグメントの長さ（秒）")
+    parser.add_argument("--rate", type=int, default=44100, help="合成するセグメントのサンプルレート")
+    parser.add_argument("--iterations", type=int, default=5, help="各段階の計測回数")
+    parser.add_argument("--warmup", type=int, default=1, help="計測前に捨てる実行回数")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="模擬サーバの応答遅延（ミリ秒）")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0.0, help="模擬サーバの受信帯域（Mbps, 0で無制限）")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    parser.add_argument("--baseline", help="比較するベースラインのJSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="ベースラインに対して許容する p50 の悪化率")
+    args = parser.parse_args()
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"不明な段階: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory(prefix="bench-segment-") as tmp:
+        segment = os.path.join(tmp, "output_bench.wav")
+        synthesize_segment(segment, args.seconds, args.rate)
+        print(f"合成セグメント: {args.seconds:.0f} 秒, {args.rate} Hz, {os.path.getsize(segment) / 1e6:.1f} MB")
+
+        ctx = multiprocessing.get_context("spawn")
+        rows = []
+        for stage in stages:
+            result_queue = ctx.Queue()
+            proc = ctx.Process(target=_run_stage, args=(stage, segment, args, result_queue))
+            proc.start()
+            result = result_queue.get()
+            proc.join()
+            if "error" in result:
+                print(f"{stage}: 実行に失敗しました: {result['error']}", file=sys.stderr)
+                sys.exit(2)
+            rows.append(summarize(result, args.seconds))
+
+    print_table(rows)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"seconds": args.seconds, "rate": args.rate, "results": rows}, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        regressions = compare_with_baseline(rows, args.baseline, args.tolerance)
+        if regressions:
+            print("性能の悪化を検出しました:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,23 +6,39 @@ import json
 import shutil
 import os
 import numpy as np
-from scipy.io import wavfile
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, sosfilt, firwin, upfirdn
 from local_settings import *
 import requests
+from requests.adapters import HTTPAdapter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
 import logging
 import time
 import threading
 import queue
+import random
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import sqlite3
 import subprocess
-import tempfile
 from pathlib import Path
 import socket
 import re
-from datetime import datetime, timedelta
+import struct
+from functools import lru_cache
+from math import gcd
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlsplit
 from zoneinfo import ZoneInfo
 from os import fspath
 
+# soundfile(libsndfile) があればFLACをメモリ上で直接エンコードする（無ければ ffmpeg / WAV で代替）
+try:
+    import soundfile as sf
+except ImportError:  # pragma: no cover - 任意依存
+    sf = None
+
 
 # ログの設定
 logging.basicConfig(
@@ -34,26 +50,458 @@ logging.basicConfig(
     ]
 )
 
+# 環境変数の真偽値を解釈
+def _bool(value) -> bool:
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+# 設定値を local_settings → 環境変数 → 既定値 の順で取得
+def _setting(name: str, default, cast=str):
+    if name in globals():
+        return globals()[name]
+    value = os.getenv(name)
+    return default if value is None else cast(value)
+
 # 録音のパラメータ設定
 FORMAT = pyaudio.paInt16 # 音声のフォーマット
 CHANNELS = 1             # モノラル
-RATE = 44100             # サンプルレート
+RATE = _setting("RATE", 44100, int)  # 録音のサンプルレート
 CHUNK = 1024             # データの読み込みサイズ
-RECORD_SECONDS = 299.8  # 録音時間
+RECORD_SECONDS = 300     # 1セグメントの録音時間（秒）
+# セグメントの区切り方。"samples": 録音開始からのサンプル数で区切る / "wallclock": 時計の区切り（例: 毎5分ちょうど）に揃える
+SEGMENT_MODE = _setting("SEGMENT_MODE", "samples")
+# 前後のセグメントを重ねる秒数（境界で発話が切れないようにする）
+OVERLAP_SECONDS = _setting("OVERLAP_SECONDS", 0.0, float)
+# 複数マイクで複数グループを録音する場合の割り当て。未設定なら既定の入力デバイスを GROUP_ID として録音する
+# 例: [{"group_id": "A", "device_index": 1}, {"group_id": "B", "device_index": 3, "channel": 0}, ...]
+DEVICES = _setting("DEVICES", None, json.loads)
+FLUSH_SECONDS = 5.0      # WAVヘッダ確定・ディスク同期の間隔（秒）
+PARTIAL_SUFFIX = ".part" # 録音中ファイルの拡張子
+
+# フィルタのパラメータ設定
+LOWCUT = 100.0               # バンドパスの下限周波数
+HIGHCUT = 4000.0             # バンドパスの上限周波数
+FILTER_ORDER = 6             # バターワースフィルタの次数
+FILTER_BLOCK_FRAMES = 65536  # フィルタを適用するブロックのフレーム数
+# アップロードする音声のサンプルレート。バンドパス後は HIGHCUT 以上の帯域が不要なため、
+# 録音より低いレートにリサンプリングしてからFLAC変換・アップロードする（0 で録音時のまま）
+PROCESS_RATE = _setting("PROCESS_RATE", 16000, int)
+
+# 無音判定（VAD）の設定。無音のセグメントはアップロードせず、前後の無音は切り詰める
+VAD_ENABLED = _setting("VAD_ENABLED", True, _bool)
+VAD_THRESHOLD_DBFS = _setting("VAD_THRESHOLD_DBFS", -50.0, float)      # これより大きいフレームを発話とみなす
+VAD_FRAME_MS = _setting("VAD_FRAME_MS", 30, int)                       # 判定するフレームの長さ
+VAD_MIN_SPEECH_RATIO = _setting("VAD_MIN_SPEECH_RATIO", 0.01, float)   # 発話フレームの割合がこれ未満ならスキップ
+VAD_PADDING_SECONDS = _setting("VAD_PADDING_SECONDS", 1.0, float)      # 切り詰める際に発話の前後に残す秒数
+VAD_REPORT_SKIPPED = _setting("VAD_REPORT_SKIPPED", True, _bool)      # スキップしたセグメントも処理依頼APIに通知する
+
+# FLAC圧縮レベル（0〜12, ffmpeg基準）。高いほどアップロードサイズが小さくCPU負荷が大きい
+FLAC_COMPRESSION_LEVEL = _setting("FLAC_COMPRESSION_LEVEL", 12, int)
+
+# 処理ワーカーとキューの設定
+PROCESS_WORKERS = _setting("PROCESS_WORKERS", 2, int)  # 並列に処理するワーカー数
+QUEUE_MAXSIZE = _setting("QUEUE_MAXSIZE", 4, int)      # 処理待ちキューの上限
+# キューが満杯のときの扱い。"block": 空くまで待つ / "drop_oldest": 最も古いものを捨てる / "spill": ディスクに退避
+QUEUE_OVERFLOW = _setting("QUEUE_OVERFLOW", "spill")
+SPILL_DIR = _setting("SPILL_DIR", "spill")             # spill 時の退避先
+
+# アップロード待ちの記録（スプール）と再送の設定
+SPOOL_PATH = _setting("SPOOL_PATH", "spool.sqlite3")            # 各セグメントの処理段階を記録するDB
+RETRY_BASE_SECONDS = _setting("RETRY_BASE_SECONDS", 5.0, float)  # 再送間隔の初期値
+RETRY_MAX_SECONDS = _setting("RETRY_MAX_SECONDS", 600.0, float)  # 再送間隔の上限
+RETRY_MAX_ATTEMPTS = _setting("RETRY_MAX_ATTEMPTS", 20, int)     # これだけ失敗したら再送を打ち切る（0で無制限）
+
+# 計測値（メトリクス）の出力設定
+METRICS_HOST = _setting("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = _setting("METRICS_PORT", 0, int)                     # Prometheus形式の /metrics を公開するポート（0で無効）
+METRICS_LOG_PATH = _setting("METRICS_LOG_PATH", "metrics.jsonl")    # JSONで定期的に書き出す先（空文字で無効）
+METRICS_LOG_SECONDS = _setting("METRICS_LOG_SECONDS", 60.0, float)  # JSONを書き出す間隔
+
+class Metrics:
+    """処理段階ごとの所要時間・バイト数・キューの深さ・失敗回数を集計する。
+    Prometheus のテキスト形式と JSON のどちらでも取り出せる。
+    """
+
+    def __init__(self, prefix: str = "ta_recorder"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}   # (name, labels) -> 値
+        self._gauges = {}     # (name, labels) -> 値
+        self._timers = {}     # (name, labels) -> [回数, 合計秒, 最大秒]
+        self._gauge_fns = {}  # name -> (ラベル名, {ラベル値: 値} を返す関数)
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def gauge_fn(self, name: str, label: str, fn) -> None:
+        """取り出すたびに fn() を呼んで値を得るゲージを登録する。"""
+        with self._lock:
+            self._gauge_fns[name] = (label, fn)
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            timer = self._timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        """with ブロックの所要時間を stage の処理時間として記録し、例外なら失敗回数を数える。"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("stage_failures_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            timers = {key: list(value) for key, value in self._timers.items()}
+            gauge_fns = dict(self._gauge_fns)
+        for name, (label, fn) in gauge_fns.items():
+            try:
+                for value_label, value in fn().items():
+                    gauges[(name, ((label, value_label),))] = value
+            except Exception as e:
+                logging.error(f"メトリクス {name} の取得に失敗: {e}")
+
+        def series(items):
+            return [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(items.items())]
+
+        return {
+            "timestamp": datetime.now(ZoneInfo("Asia/Tokyo")).isoformat(),
+            "counters": series(counters),
+            "gauges": series(gauges),
+            "timers": [
+                {"name": name, "labels": dict(labels), "count": count, "sum": total, "max": peak}
+                for (name, labels), (count, total, peak) in sorted(timers.items())
+            ],
+        }
 
-# バターワースフィルタ
-def butter_bandpass(lowcut, highcut, fs, order=5):
+    def render_prometheus(self) -> str:
+        snap = self.snapshot()
+
+        def fmt(name, labels, value):
+            label_str = ",".join(f'{k}="{str(v)}"' for k, v in labels.items())
+            return f"{self.prefix}_{name}{{{label_str}}} {value}" if label_str else f"{self.prefix}_{name} {value}"
+
+        lines = []
+        for kind, items in (("counter", snap["counters"]), ("gauge", snap["gauges"])):
+            for name in sorted({item["name"] for item in items}):
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+                lines.extend(fmt(name, item["labels"], item["value"]) for item in items if item["name"] == name)
+        for name in sorted({item["name"] for item in snap["timers"]}):
+            items = [item for item in snap["timers"] if item["name"] == name]
+            lines.append(f"# TYPE {self.prefix}_{name} summary")
+            for item in items:
+                lines.append(fmt(f"{name}_count", item["labels"], item["count"]))
+                lines.append(fmt(f"{name}_sum", item["labels"], f"{item['sum']:.6f}"))
+            lines.append(f"# TYPE {self.prefix}_{name}_max gauge")
+            lines.extend(fmt(f"{name}_max", item["labels"], f"{item['max']:.6f}") for item in items)
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path in ("/", "/metrics"):
+            body, content_type = METRICS.render_prometheus().encode(), "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(METRICS.snapshot(), ensure_ascii=False).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# /metrics（Prometheus形式）と /metrics.json を公開するHTTPサーバを起動
+def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info(f"メトリクスを http://{host}:{server.server_port}/metrics で公開します")
+    return server
+
+# メトリクスを一定間隔で JSON Lines として書き出す
+def metrics_logger(stop_event: threading.Event, path: str = METRICS_LOG_PATH, interval: float = METRICS_LOG_SECONDS):
+    while not stop_event.wait(interval):
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(METRICS.snapshot(), ensure_ascii=False) + "\n")
+        except OSError as e:
+            logging.error(f"メトリクスの書き出しに失敗: {e}")
+
+# バターワースフィルタの2次セクション(SOS)形式の係数。高次でも数値的に安定で、同じ条件なら再計算しない
+@lru_cache(maxsize=32)
+def butter_bandpass_sos(lowcut, highcut, fs, order=5):
     nyq = 0.5 * fs
     low = lowcut / nyq
     high = highcut / nyq
-    b, a = butter(order, [low, high], btype='band')
-    return b, a
+    sos = butter(order, [low, high], btype='band', output='sos')
+    return sos
 
 def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
-    b, a = butter_bandpass(lowcut, highcut, fs, order=order)
-    y = lfilter(b, a, data)
+    sos = butter_bandpass_sos(lowcut, highcut, fs, order=order)
+    y = sosfilt(sos, data, axis=0)
     return y
 
+class BandpassFilter:
+    """ブロック単位で適用できるバンドパスフィルタ。
+    フィルタ状態(zi)をブロック間で引き継ぐため、全体を一度に処理した結果と一致する。
+    録音中のチャンクにも、ファイルを分割して読んだブロックにも使える。
+    """
+
+    def __init__(self, lowcut, highcut, fs, order=5):
+        self.sos = butter_bandpass_sos(lowcut, highcut, fs, order=order)
+        self._zi = None
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """(frames,) または (frames, channels) のブロックを処理し float64 で返す。"""
+        if self._zi is None:
+            self._zi = np.zeros((self.sos.shape[0], 2) + block.shape[1:])
+        y, self._zi = sosfilt(self.sos, block, axis=0, zi=self._zi)
+        return y
+
+    def process_int16(self, block: np.ndarray) -> np.ndarray:
+        y = self.process(block)
+        return np.clip(y, -32768, 32767).astype(np.int16)
+
+class PolyphaseResampler:
+    """ブロック単位で使えるポリフェーズリサンプラ。
+    scipy.signal.resample_poly と同じFIRを使い、ブロック間で入力の履歴を引き継ぐため、
+    全体を一度に resample_poly した結果と一致する（最後に flush() で残りを取り出す）。
+    """
+
+    def __init__(self, fs_in: int, fs_out: int):
+        g = gcd(fs_in, fs_out)
+        self.up = fs_out // g
+        self.down = fs_in // g
+        max_rate = max(self.up, self.down)
+        half_len = 10 * max_rate
+        h = firwin(2 * half_len + 1, 1.0 / max_rate, window=('kaiser', 5.0)) * self.up
+        # resample_poly と同じく、出力の遅延がちょうど n_pre_remove サンプルになるよう先頭を0で埋める
+        n_pre_pad = self.down - half_len % self.down
+        self.h = np.concatenate((np.zeros(n_pre_pad), h))
+        self._skip = (half_len + n_pre_pad) // self.down  # 捨てる先頭の出力数
+        self._buf = None      # 未使用分を含む入力の履歴
+        self._buf_start = 0   # _buf[0] の入力全体での位置（down の倍数）
+        self._out_next = 0    # 次に出力する位置
+        self._in_total = 0
+
+    def _run(self, block: np.ndarray) -> np.ndarray:
+        block = np.asarray(block, dtype=np.float64)
+        buf = block if self._buf is None else np.concatenate((self._buf, block))
+        buf_end = self._buf_start + len(buf)
+        # 手元の入力だけで計算できる出力の範囲 [_out_next, out_end)
+        out_end = (buf_end - 1) * self.up // self.down + 1 if len(buf) else self._out_next
+        offset = self._buf_start * self.up // self.down
+        y = upfirdn(self.h, buf, self.up, self.down, axis=0)[self._out_next - offset:out_end - offset]
+        self._out_next = max(self._out_next, out_end)
+        # 次の出力に必要な入力だけを残す
+        keep_from = max(0, -(-(self._out_next * self.down - len(self.h) + 1) // self.up))
+        keep_from = min(keep_from - keep_from % self.down, buf_end - buf_end % self.down)
+        self._buf = buf[keep_from - self._buf_start:]
+        self._buf_start = keep_from
+        return y
+
+    def _trim(self, y: np.ndarray, produced_before: int, limit: int) -> np.ndarray:
+        # 全体での出力位置 [produced_before, produced_before + len(y)) のうち、遅延分と末尾の余りを除く
+        start = max(0, self._skip - produced_before)
+        stop = max(start, min(len(y), limit + self._skip - produced_before))
+        return y[start:stop]
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        self._in_total += len(block)
+        before = self._out_next
+        return self._trim(self._run(block), before, 1 << 62)
+
+    def flush(self) -> np.ndarray:
+        """入力の終わりを0で埋め、残りの出力を返す。"""
+        n_out = -(-self._in_total * self.up // self.down)
+        tail_shape = (len(self.h) // self.up + self.down + 1,) + (() if self._buf is None else self._buf.shape[1:])
+        before = self._out_next
+        return self._trim(self._run(np.zeros(tail_shape)), before, n_out)
+
+# リサンプリング後のサンプルレート（アップサンプリングはしない）
+def _output_rate(fs: int, target_rate: int | None = PROCESS_RATE) -> int:
+    return min(fs, target_rate) if target_rate else fs
+
+def iter_filtered_blocks(path: str, lowcut=LOWCUT, highcut=HIGHCUT, order=FILTER_ORDER,
+                         block_frames: int = FILTER_BLOCK_FRAMES, target_rate: int | None = PROCESS_RATE):
+    """16bit PCM の WAV をブロックごとに読み、リサンプリングとバンドパスフィルタを掛けた
+    int16 ブロックを返すジェネレータ。ファイル全体を読み込まないため、使用メモリはセグメント長によらず一定。
+    リサンプリングを先に行うので、IIRフィルタは低いレートで動き計算量も減る。
+    """
+    with wave.open(path, 'rb') as src:
+        if src.getsampwidth() != 2:
+            raise ValueError(f"16bit PCM のみ対応しています: {path}")
+        channels = src.getnchannels()
+        fs = src.getframerate()
+        out_fs = _output_rate(fs, target_rate)
+        resampler = PolyphaseResampler(fs, out_fs) if out_fs != fs else None
+        # 上限周波数は出力のナイキスト周波数未満に収める
+        bp = BandpassFilter(lowcut, min(highcut, 0.45 * out_fs), out_fs, order=order)
+        while True:
+            raw = src.readframes(block_frames)
+            if not raw:
+                break
+            block = np.frombuffer(raw, dtype='<i2')
+            if channels > 1:
+                block = block.reshape(-1, channels)
+            if resampler is not None:
+                block = resampler.process(block)
+            yield bp.process_int16(block)
+        if resampler is not None:
+            yield bp.process_int16(resampler.flush())
+
+# WAVヘッダ（44バイト, PCM）を生成
+def _wav_header(channels: int, sampwidth: int, rate: int, data_bytes: int) -> bytes:
+    block_align = channels * sampwidth
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_bytes, b'WAVE',
+        b'fmt ', 16, 1, channels, rate, rate * block_align, block_align, sampwidth * 8,
+        b'data', data_bytes,
+    )
+
+WAV_HEADER_SIZE = len(_wav_header(1, 2, RATE, 0))
+
+class DiskSyncer:
+    """os.fsync を録音スレッドの外で行う。
+    SDカードなどでは fsync が入力バッファの保持時間より長く止まることがあり、
+    録音ループで呼ぶと取りこぼし（無音の欠落）になるため専用スレッドに任せる。
+    """
+
+    def __init__(self):
+        self._q = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, fd: int, done=None) -> None:
+        """fd を同期するよう依頼する。fd は複製して使うので、呼び出し側はすぐ閉じてよい。"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="disk-syncer", daemon=True)
+                self._thread.start()
+        self._q.put((os.dup(fd), done))
+
+    def _run(self) -> None:
+        while True:
+            fd, done = self._q.get()
+            try:
+                with METRICS.timer("fsync"):
+                    os.fsync(fd)
+            except OSError as e:
+                logging.warning(f"録音ファイルのディスク同期に失敗: {e}")
+            finally:
+                os.close(fd)
+                if done is not None:
+                    done()
+
+DISK_SYNCER = DiskSyncer()
+
+class StreamingWavWriter:
+    """PCMをチャンク到着ごとにWAVへ追記する。
+    ヘッダは flush_seconds ごとと close 時に確定させるため、
+    プロセスが落ちても失うのは最後の数秒分だけになる。
+    ヘッダの書き換えは位置指定の書き込みだけで済ませ、ディスクへの同期は DISK_SYNCER に任せる。
+    """
+
+    def __init__(self, path: str, channels: int, sampwidth: int, rate: int,
+                 flush_seconds: float = FLUSH_SECONDS):
+        self.path = path
+        self.channels = channels
+        self.sampwidth = sampwidth
+        self.rate = rate
+        self.data_bytes = 0
+        self._flush_bytes = max(1, int(rate * flush_seconds)) * channels * sampwidth
+        self._unflushed = 0
+        self._sync_pending = False
+        self._f = open(path, 'wb')
+        self._f.write(_wav_header(channels, sampwidth, rate, 0))
+
+    @property
+    def frames(self) -> int:
+        return self.data_bytes // (self.channels * self.sampwidth)
+
+    def write(self, data: bytes) -> None:
+        self._f.write(data)
+        self.data_bytes += len(data)
+        self._unflushed += len(data)
+        if self._unflushed >= self._flush_bytes:
+            self.flush()
+
+    def _patch_header(self) -> None:
+        self._f.flush()
+        header = _wav_header(self.channels, self.sampwidth, self.rate, self.data_bytes)
+        if hasattr(os, "pwrite"):
+            os.pwrite(self._f.fileno(), header, 0)
+        else:  # pragma: no cover - pwrite の無い環境
+            pos = self._f.tell()
+            self._f.seek(0)
+            self._f.write(header)
+            self._f.seek(pos)
+            self._f.flush()
+
+    def _sync_done(self) -> None:
+        self._sync_pending = False
+
+    def flush(self) -> None:
+        """現在のデータ長でヘッダを書き換え、ディスクへの同期を依頼する（完了は待たない）。"""
+        self._patch_header()
+        self._unflushed = 0
+        # 前回の同期が終わっていなければ重ねて依頼しない
+        if not self._sync_pending:
+            self._sync_pending = True
+            DISK_SYNCER.submit(self._f.fileno(), self._sync_done)
+
+    def close(self) -> None:
+        if self._f.closed:
+            return
+        try:
+            self._patch_header()
+            DISK_SYNCER.submit(self._f.fileno())
+        finally:
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def repair_wav_header(path: str, channels: int = CHANNELS, sampwidth: int = 2, rate: int = RATE) -> int:
+    """途中で中断されたWAVのヘッダをファイルサイズに合わせて修復し、フレーム数を返す。"""
+    block_align = channels * sampwidth
+    size = os.path.getsize(path)
+    data_bytes = max(0, size - WAV_HEADER_SIZE)
+    data_bytes -= data_bytes % block_align
+    with open(path, 'r+b') as f:
+        f.truncate(WAV_HEADER_SIZE + data_bytes)
+        f.seek(0)
+        f.write(_wav_header(channels, sampwidth, rate, data_bytes))
+    return data_bytes // block_align
+
 # Worker API ベースURL（local_settings または環境変数から取得）
 try:
     WORKER_API_BASE_URL = WORKER_API_BASE_URL  # type: ignore[name-defined]
@@ -64,6 +512,12 @@ except NameError:
 if WORKER_API_BASE_URL.endswith('/'):
     WORKER_API_BASE_URL = WORKER_API_BASE_URL[:-1]
 
+# Worker API / R2 への接続設定
+UPLOAD_CONCURRENCY = _setting("UPLOAD_CONCURRENCY", 2, int)           # 同時に行うR2アップロード数の上限
+SIGNED_URL_PREFETCH = _setting("SIGNED_URL_PREFETCH", 1, int)         # 先に取得しておく署名URLの数（0で無効）
+SIGNED_URL_TTL_SECONDS = _setting("SIGNED_URL_TTL_SECONDS", 300.0, float)  # 有効期限が分からない署名URLを使ってよい期間
+SIGNED_URL_EXPIRY_MARGIN_SECONDS = _setting("SIGNED_URL_EXPIRY_MARGIN_SECONDS", 60.0, float)  # 有効期限のこれだけ前で使うのをやめる
+
 def _resolve_start_at(target_str: str, tz: ZoneInfo) -> datetime:
     """指定文字列から起動時刻(datetime)を決定する。"""
     target_str = target_str.strip()
@@ -116,26 +570,155 @@ def wait_until(start_at: str, tz: ZoneInfo = ZoneInfo("Asia/Tokyo")) -> None:
     time.sleep(remaining)
     logging.info("指定時刻に到達したため処理を開始します")
 
-def _convert_to_flac(input_path: str) -> tuple[str, str]:
-    """ffmpegでFLACに変換し、(flac_path, content_type) を返す。
-    失敗時は (input_path, 推定content_type) を返す。
-    """
-    src = Path(input_path)
-    out_path = src.parent / f"{src.stem}.flac"
+def _encode_with_soundfile(blocks, fs: int, channels: int, level: int) -> bytes:
+    buf = io.BytesIO()
+    # libsndfile の圧縮レベルは 0.0〜1.0（FLACレベル0〜8に対応）
+    with sf.SoundFile(buf, 'w', samplerate=fs, channels=channels, subtype='PCM_16',
+                      format='FLAC', compression_level=min(level, 8) / 8) as out:
+        for block in blocks:
+            out.write(block)
+    return buf.getvalue()
+
+def _encode_with_ffmpeg(blocks, fs: int, channels: int, level: int) -> bytes:
+    """生PCMをパイプで ffmpeg に渡し、FLACを標準出力から受け取る（ディスクを経由しない）。"""
     ffmpeg_cmd = [
-        "ffmpeg", "-y", "-i", str(src), "-c:a", "flac", "-compression_level", "12", str(out_path)
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "s16le", "-ar", str(fs), "-ac", str(channels), "-i", "pipe:0",
+        "-c:a", "flac", "-compression_level", str(level), "-f", "flac", "pipe:1",
     ]
+    proc = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    total_frames = 0
+
+    def feed():
+        nonlocal total_frames
+        try:
+            for block in blocks:
+                proc.stdin.write(block.astype('<i2', copy=False).tobytes())
+                total_frames += len(block)
+        except BrokenPipeError:
+            pass
+        finally:
+            proc.stdin.close()
+
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+    out = proc.stdout.read()
+    writer.join()
+    stderr = proc.stderr.read()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, ffmpeg_cmd, output=out, stderr=stderr)
+    return _patch_flac_total_samples(out, total_frames)
+
+def _patch_flac_total_samples(data: bytes, total_frames: int) -> bytes:
+    """パイプ出力では ffmpeg が STREAMINFO の総サンプル数を書き戻せないため、ここで埋める。"""
+    # "fLaC" + メタデータブロックヘッダ(4) の後が STREAMINFO。先頭10バイト目から
+    # サンプルレート(20bit)/チャンネル(3bit)/ビット深度(5bit)/総サンプル数(36bit) が続く
+    if data[:4] != b'fLaC' or len(data) < 42 or data[4] & 0x7F != 0:
+        return data
+    offset = 8 + 10
+    packed = int.from_bytes(data[offset:offset + 8], 'big')
+    packed = (packed & ~((1 << 36) - 1)) | (total_frames & ((1 << 36) - 1))
+    return data[:offset] + packed.to_bytes(8, 'big') + data[offset + 8:]
+
+def _encode_wav(blocks, fs: int, channels: int) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as out:
+        out.setnchannels(channels)
+        out.setsampwidth(2)
+        out.setframerate(fs)
+        for block in blocks:
+            out.writeframesraw(block.astype('<i2', copy=False).tobytes())
+    return buf.getvalue()
+
+def _iter_blocks(samples: np.ndarray, block_frames: int = FILTER_BLOCK_FRAMES):
+    for start in range(0, len(samples), block_frames):
+        yield samples[start:start + block_frames]
+
+def filter_segment(path: str) -> tuple[np.ndarray, int]:
+    """録音ファイルをリサンプリングしてバンドパスフィルタを掛け、(int16 配列, サンプルレート) を返す。
+    出力配列はあらかじめ確保し、ブロックごとに書き込む（float64 の一時配列は1ブロック分のみ）。
+    """
+    with wave.open(path, 'rb') as src:
+        in_fs, channels, nframes = src.getframerate(), src.getnchannels(), src.getnframes()
+    fs = _output_rate(in_fs)
+    nframes = -(-nframes * fs // in_fs)
+    out = np.empty((nframes,) if channels == 1 else (nframes, channels), dtype=np.int16)
+    pos = 0
+    for block in iter_filtered_blocks(path):
+        out[pos:pos + len(block)] = block
+        pos += len(block)
+    return out[:pos], fs
+
+def encode_audio(samples: np.ndarray, fs: int, level: int = FLAC_COMPRESSION_LEVEL) -> tuple[bytes, str, str]:
+    """int16 の音声をメモリ上でFLACに変換し、(音声データ, content_type, 拡張子) を返す。
+    FLACにできない場合はWAVで返す。
+    """
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    if sf is not None:
+        try:
+            return _encode_with_soundfile(_iter_blocks(samples), fs, channels, level), "audio/flac", ".flac"
+        except Exception as e:
+            logging.error(f"soundfile によるFLAC変換に失敗しました: {e}")
     try:
-        subprocess.run(ffmpeg_cmd, check=True, capture_output=True, text=True)
-        logging.info(f"FLAC変換完了: {out_path}")
-        return str(out_path), "audio/flac"
+        data = _encode_with_ffmpeg(_iter_blocks(samples), fs, channels, level)
+        logging.info("FLAC変換完了")
+        return data, "audio/flac", ".flac"
     except FileNotFoundError:
-        logging.error("'ffmpeg' が見つかりません。FLAC出力には ffmpeg が必要です。WAVのまま続行します。")
-        # WAVのままアップロード
-        return str(src), "audio/wav"
+        logging.error("'ffmpeg' が見つかりません。FLAC出力には soundfile か ffmpeg が必要です。WAVのまま続行します。")
     except subprocess.CalledProcessError as e:
         logging.error("ffmpeg によるFLAC変換に失敗しました: %s", e.stderr)
-        return str(src), "audio/wav"
+    # WAVのままアップロード
+    return _encode_wav(_iter_blocks(samples), fs, channels), "audio/wav", ".wav"
+
+class SpeechActivity:
+    """無音判定の結果。start/end は発話を含む範囲（フレーム位置）。"""
+
+    def __init__(self, speech_ratio: float, start: int, end: int, total: int, fs: int):
+        self.speech_ratio = speech_ratio
+        self.start = start
+        self.end = end
+        self.total = total
+        self.fs = fs
+
+    @property
+    def is_silent(self) -> bool:
+        return self.speech_ratio < VAD_MIN_SPEECH_RATIO
+
+    def metadata(self) -> dict:
+        """処理依頼に添えるメタデータ。"""
+        return {
+            "speechRatio": round(self.speech_ratio, 4),
+            "durationSeconds": round(self.total / self.fs, 2),
+            "trimStartSeconds": round(self.start / self.fs, 2),  # アップロードした音声の先頭が録音の何秒目か
+            "trimmedSeconds": round((self.total - (self.end - self.start)) / self.fs, 2),
+        }
+
+def detect_speech(samples: np.ndarray, fs: int, threshold_dbfs: float = VAD_THRESHOLD_DBFS,
+                  frame_ms: int = VAD_FRAME_MS, padding_seconds: float = VAD_PADDING_SECONDS) -> SpeechActivity:
+    """フレームごとのエネルギー(dBFS)で発話区間を判定する。"""
+    x = samples if samples.ndim == 1 else samples[:, 0]
+    frame = max(1, int(fs * frame_ms / 1000))
+    n = len(x) // frame
+    if n == 0:
+        return SpeechActivity(0.0, 0, 0, len(x), fs)
+
+    # 平均二乗を dBFS に変換（float32 への変換は一度に数千フレームずつ行い、一時メモリを抑える）
+    energy = np.empty(n, dtype=np.float32)
+    step = 4096
+    for i in range(0, n, step):
+        frames = x[i * frame:min(n, i + step) * frame].reshape(-1, frame).astype(np.float32)
+        energy[i:i + len(frames)] = np.einsum('ij,ij->i', frames, frames) / frame
+    dbfs = 10 * np.log10(energy / (32768.0 ** 2) + 1e-12)
+    speech = dbfs > threshold_dbfs
+
+    speech_ratio = float(speech.mean())
+    if not speech.any():
+        return SpeechActivity(0.0, 0, 0, len(x), fs)
+    idx = np.flatnonzero(speech)
+    pad = int(padding_seconds * fs)
+    start = max(0, idx[0] * frame - pad)
+    end = min(len(x), (idx[-1] + 1) * frame + pad)
+    return SpeechActivity(speech_ratio, int(start), int(end), len(x), fs)
 
 
 # session_id 生成（GROUP_ID + ホスト名 + 日付（Asia/Tokyo））
@@ -146,137 +729,750 @@ def generate_session_id(group_id: str) -> str:
     date_str = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y%m%d")
     return f"{safe_group}-{safe_host}-{date_str}"
 
-# アップロード用の署名URLを取得
-def get_signed_upload_url(content_type: str):
-    url = f"{WORKER_API_BASE_URL}/api/generate-upload-url"
+# 署名URL（S3互換の SigV4 形式）のクエリから有効期限（UNIX時刻）を求める。分からなければ None
+def signed_url_expiry(upload_url: str) -> float | None:
+    query = parse_qs(urlsplit(upload_url).query)
     try:
-        resp = requests.post(url, json={"contentType": content_type}, timeout=60)
+        signed_at = datetime.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        return signed_at.timestamp() + int(query["X-Amz-Expires"][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+class WorkerApiClient:
+    """Worker API と R2 への通信をまとめたクライアント。
+    Session を使い回して接続（TCP/TLS）を再利用し、署名URLは使う前に先読みしておく。
+    先読みした署名URLは URL に含まれる有効期限の expiry_margin 秒前まで使い、
+    期限が分からないものは取得から url_ttl 秒まで使う。
+    R2へのPUTは upload_concurrency 件までに制限して並列に行う。
+    """
+
+    def __init__(self, base_url: str = WORKER_API_BASE_URL, upload_concurrency: int = UPLOAD_CONCURRENCY,
+                 prefetch: int = SIGNED_URL_PREFETCH, url_ttl: float = SIGNED_URL_TTL_SECONDS,
+                 expiry_margin: float = SIGNED_URL_EXPIRY_MARGIN_SECONDS):
+        self.base_url = base_url.rstrip('/')
+        self.prefetch = max(0, prefetch)
+        self.url_ttl = url_ttl
+        self.expiry_margin = expiry_margin
+        self.session = requests.Session()
+        pool_size = max(4, upload_concurrency + PROCESS_WORKERS + self.prefetch)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._upload_slots = threading.BoundedSemaphore(max(1, upload_concurrency))
+        self._signed_urls = {}  # content_type -> deque[(使える期限（monotonic）, upload_url, object_key)]
+        self._lock = threading.Lock()
+        self._prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="signed-url-prefetch")
+
+    def _fetch_signed_upload_url(self, content_type: str):
+        url = f"{self.base_url}/api/generate-upload-url"
+        resp = self.session.post(url, json={"contentType": content_type}, timeout=60)
         resp.raise_for_status()
         body = resp.json()
         upload_url = body.get("uploadUrl")
         object_key = body.get("objectKey")
         if not upload_url or not object_key:
             raise ValueError("署名URLレスポンスに uploadUrl/objectKey がありません")
-        logging.info("署名付きURLを取得しました")
         return upload_url, object_key
-    except Exception as e:
-        logging.error(f"署名付きURL取得に失敗: {e}")
-        raise
 
-# 署名URLに対して音声をPUTでアップロード
-def upload_to_r2(upload_url: str, file_path: str, content_type: str):
-    try:
-        with open(file_path, "rb") as f:
+    def _usable_until(self, upload_url: str) -> float:
+        """先読みした署名URLを使ってよい期限を time.monotonic() 基準で返す。"""
+        now = time.monotonic()
+        expiry = signed_url_expiry(upload_url)
+        if expiry is None:
+            return now + self.url_ttl
+        return now + (expiry - time.time()) - self.expiry_margin
+
+    def _take_prefetched(self, content_type: str):
+        now = time.monotonic()
+        with self._lock:
+            urls = self._signed_urls.get(content_type)
+            while urls:
+                usable_until, upload_url, object_key = urls.popleft()
+                if now < usable_until:
+                    return upload_url, object_key
+                METRICS.inc("signed_url_prefetch_expired_total")
+        return None
+
+    def _refill(self, content_type: str) -> None:
+        try:
+            while True:
+                with self._lock:
+                    urls = self._signed_urls.setdefault(content_type, deque())
+                    if len(urls) >= self.prefetch:
+                        return
+                upload_url, object_key = self._fetch_signed_upload_url(content_type)
+                with self._lock:
+                    urls.append((self._usable_until(upload_url), upload_url, object_key))
+        except Exception as e:
+            logging.warning(f"署名付きURLの先読みに失敗: {e}")
+
+    def prefetch_signed_urls(self, content_type: str) -> None:
+        """署名URLをバックグラウンドで先読みしておく。
+        使う直前（セグメントの録音終了時）に呼ぶ。使った直後に呼ぶと次に使うまで1区間待つことになり、期限切れになりやすい。
+        """
+        if self.prefetch:
+            self._prefetcher.submit(self._refill, content_type)
+
+    # アップロード用の署名URLを取得
+    def get_signed_upload_url(self, content_type: str):
+        try:
+            signed = self._take_prefetched(content_type)
+            if signed is None:
+                with METRICS.timer("signed_url"):
+                    signed = self._fetch_signed_upload_url(content_type)
+                logging.info("署名付きURLを取得しました")
+            else:
+                METRICS.inc("signed_url_prefetch_hits_total")
+                logging.info("先読みした署名付きURLを使用します")
+            return signed
+        except Exception as e:
+            logging.error(f"署名付きURL取得に失敗: {e}")
+            raise
+
+    # 署名URLに対して音声をPUTでアップロード（ファイルパスかメモリ上のデータを受け付ける）
+    def upload_to_r2(self, upload_url: str, file_path: str | bytes, content_type: str):
+        try:
             headers = {"Content-Type": content_type}
-            resp = requests.put(upload_url, data=f, headers=headers, timeout=300)
-        if not (200 <= resp.status_code < 300):
-            raise RuntimeError(f"R2アップロード失敗: status={resp.status_code} body={resp.text[:200]}")
-        logging.info("R2へアップロード完了")
-    except Exception as e:
-        logging.error(f"R2アップロード中にエラー: {e}")
-        raise
+            waited_from = time.perf_counter()
+            with self._upload_slots, METRICS.timer("upload"):
+                METRICS.observe("upload_slot_wait_seconds", time.perf_counter() - waited_from)
+                if isinstance(file_path, (bytes, bytearray)):
+                    size = len(file_path)
+                    resp = self.session.put(upload_url, data=file_path, headers=headers, timeout=300)
+                else:
+                    size = os.path.getsize(file_path)
+                    with open(file_path, "rb") as f:
+                        resp = self.session.put(upload_url, data=f, headers=headers, timeout=300)
+                if not (200 <= resp.status_code < 300):
+                    raise RuntimeError(f"R2アップロード失敗: status={resp.status_code} body={resp.text[:200]}")
+            METRICS.inc("uploaded_bytes_total", size)
+            logging.info("R2へアップロード完了")
+        except Exception as e:
+            logging.error(f"R2アップロード中にエラー: {e}")
+            raise
 
-# 文字起こしの処理依頼
-def request_transcription(object_key: str, session_id: str, group_id: str):
-    url = f"{WORKER_API_BASE_URL}/api/process-request"
-    payload = {"objectKey": object_key, "sessionId": session_id, "groupId": group_id}
-    try:
-        resp = requests.post(url, json=payload, timeout=60)
-        if resp.status_code not in (200, 201, 202):
-            raise RuntimeError(f"処理依頼失敗: status={resp.status_code} body={resp.text[:200]}")
-        body = resp.json() if resp.content else {}
-        job_id = body.get("jobId")
-        if job_id:
-            logging.info(f"処理依頼を受理: jobId={job_id}")
+    # 文字起こしの処理依頼
+    def request_transcription(self, object_key: str | None, session_id: str, group_id: str,
+                              metadata: dict | None = None):
+        url = f"{self.base_url}/api/process-request"
+        payload = {"objectKey": object_key, "sessionId": session_id, "groupId": group_id}
+        if metadata:
+            payload.update(metadata)
+        try:
+            with METRICS.timer("process_request"):
+                resp = self.session.post(url, json=payload, timeout=60)
+                if resp.status_code not in (200, 201, 202):
+                    raise RuntimeError(f"処理依頼失敗: status={resp.status_code} body={resp.text[:200]}")
+            body = resp.json() if resp.content else {}
+            job_id = body.get("jobId")
+            if job_id:
+                logging.info(f"処理依頼を受理: jobId={job_id}")
+            else:
+                logging.info("処理依頼を受理（jobId未返却）")
+        except Exception as e:
+            logging.error(f"処理依頼中にエラー: {e}")
+            raise
+
+    def close(self) -> None:
+        self._prefetcher.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+_api_client = None
+_api_client_lock = threading.Lock()
+
+# プロセス共通の Worker API クライアント
+def get_api_client() -> WorkerApiClient:
+    global _api_client
+    with _api_client_lock:
+        if _api_client is None:
+            _api_client = WorkerApiClient()
+        return _api_client
+
+def get_signed_upload_url(content_type: str):
+    return get_api_client().get_signed_upload_url(content_type)
+
+def upload_to_r2(upload_url: str, file_path: str | bytes, content_type: str):
+    return get_api_client().upload_to_r2(upload_url, file_path, content_type)
+
+def request_transcription(object_key: str | None, session_id: str, group_id: str, metadata: dict | None = None):
+    return get_api_client().request_transcription(object_key, session_id, group_id, metadata)
+
+# 同名ファイルが既にあれば連番を付けたパスを返す
+def _unique_path(path: str) -> str:
+    if not os.path.exists(path):
+        return path
+    directory, name = os.path.split(path)
+    stem, dot, ext = name.partition(".")
+    i = 1
+    while os.path.exists(os.path.join(directory, f"{stem}_{i}{dot}{ext}")):
+        i += 1
+    return os.path.join(directory, f"{stem}_{i}{dot}{ext}")
+
+class SegmentRotator:
+    """1本の入力ストリームから途切れなくセグメントを切り出す。
+    区切りはサンプル数で決めるため、録音を止めずに境界のずれも蓄積しない。
+    wallclock モードでは区切りのたびに次の境界を時計から求め直し、
+    サウンドカードのクロック誤差で時計の区切りからずれていかないようにする。
+    overlap_seconds を指定すると、次のセグメントを境界の手前から書き始める。
+    """
+
+    def __init__(self, on_segment, channels: int, sampwidth: int, rate: int,
+                 segment_seconds: float, mode: str = "samples", overlap_seconds: float = 0.0,
+                 prefix: str = "output"):
+        if mode not in ("samples", "wallclock"):
+            raise ValueError(f"SEGMENT_MODE は 'samples' か 'wallclock' を指定してください: {mode}")
+        self.on_segment = on_segment
+        self.channels = channels
+        self.sampwidth = sampwidth
+        self.rate = rate
+        self.prefix = prefix
+        self.frame_bytes = channels * sampwidth
+        self.mode = mode
+        self.segment_seconds = segment_seconds
+        self.segment_frames = int(round(segment_seconds * rate))
+        self.overlap_frames = int(round(overlap_seconds * rate))
+        if not 0 <= self.overlap_frames < self.segment_frames:
+            raise ValueError("OVERLAP_SECONDS はセグメント長未満の0以上の値を指定してください")
+
+        self.pos = 0       # これまでに書き込んだフレーム数
+        self._received = 0 # 受け取り済みのフレーム数（最新のフレームが現在時刻に相当する）
+        self._open = []    # 書き込み中のセグメント [(writer, end_pos)]
+        # 最初のセグメントは即座に開始し、終端（最初の境界）を決める
+        self._next_start = 0
+        self._next_end = self.segment_frames
+        if mode == "wallclock":
+            now = time.time()
+            remaining = segment_seconds - (now % segment_seconds)
+            first = int(round(remaining * rate))
+            # 次の区切りまで1秒未満（または重なり以下）なら短すぎるので1区間先まで延ばす
+            too_short = first < max(rate, self.overlap_frames + 1)
+            self._next_end = first + self.segment_frames if too_short else first
+
+    def _open_segment(self) -> None:
+        start_ts = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y%m%d-%H%M%S")
+        partial_path = _unique_path(f"{self.prefix}_{start_ts}.wav{PARTIAL_SUFFIX}")
+        writer = StreamingWavWriter(partial_path, self.channels, self.sampwidth, self.rate)
+        self._open.append((writer, self._next_end))
+        logging.info(f"録音開始: {partial_path}")
+        # 次のセグメントは境界から overlap 分だけ手前で開始する
+        self._next_start = self._next_end - self.overlap_frames
+        if self.mode == "wallclock":
+            self._next_end = self._clock_boundary_after(self._next_end)
         else:
-            logging.info("処理依頼を受理（jobId未返却）")
-    except Exception as e:
-        logging.error(f"処理依頼中にエラー: {e}")
-        raise
+            self._next_end += self.segment_frames
 
-# 録音関数
-def record_audio(q, record_seconds):
-    while True:
-        audio = pyaudio.PyAudio()
+    def _clock_boundary_after(self, end: int) -> int:
+        """フレーム位置 end の次の時計の区切りを、現在時刻から求め直してフレーム位置で返す。"""
+        now = time.time()
+        end_time = now + (end - self._received) / self.rate
+        # end は時計の区切りに揃っているはずなので、最寄りの区切りの1区間先を次の境界とする
+        boundary = (round(end_time / self.segment_seconds) + 1) * self.segment_seconds
+        next_end = self._received + int(round((boundary - now) * self.rate))
+        # 時計が大きく飛んだ場合などはサンプル数での区切りに戻す
+        if abs(next_end - (end + self.segment_frames)) > self.segment_frames // 2:
+            return end + self.segment_frames
+        return next_end
 
-        # 録音設定
-        stream = audio.open(format=FORMAT, channels=CHANNELS,
-                            rate=RATE, input=True,
-                            frames_per_buffer=CHUNK)
-        logging.info("録音開始")
+    def _finish_segment(self, writer: StreamingWavWriter) -> None:
+        writer.close()
+        ts = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y%m%d-%H%M%S")
+        filename = _unique_path(f"{self.prefix}_{ts}.wav")
+        os.replace(writer.path, filename)
+        logging.info(f"録音終了: {filename} ({writer.frames / self.rate:.1f} 秒)")
+        self.on_segment(filename)
 
-        frames = []
+    def feed(self, data: bytes) -> None:
+        """チャンクを受け取り、境界で分割して書き込み中の各セグメントへ追記する。"""
+        n = len(data) // self.frame_bytes
+        self._received = self.pos + n
+        offset = 0
+        while True:
+            if self.pos == self._next_start:
+                self._open_segment()
+            for writer, end in [seg for seg in self._open if seg[1] == self.pos]:
+                self._open.remove((writer, end))
+                self._finish_segment(writer)
+            if offset >= n:
+                break
+            until_event = min([self._next_start - self.pos] + [end - self.pos for _, end in self._open])
+            step = min(n - offset, until_event)
+            piece = data[offset * self.frame_bytes:(offset + step) * self.frame_bytes]
+            for writer, _ in self._open:
+                writer.write(piece)
+            self.pos += step
+            offset += step
 
-        # 録音
-        for i in range(0, int(RATE / CHUNK * record_seconds)):
-            data = stream.read(CHUNK, exception_on_overflow=False)
-            frames.append(data)
+    def close(self) -> None:
+        """書き込み中のセグメントを確定させる（終了時の端数も処理対象にする）。"""
+        for writer, _ in self._open:
+            if writer.frames > 0:
+                self._finish_segment(writer)
+            else:
+                writer.close()
+                os.remove(writer.path)
+        self._open = []
 
-        logging.info("録音終了")
+# 入力デバイスごとに {チャンネル: グループID} の割り当てを返す（None は既定の入力デバイス）
+def load_device_groups(devices=None) -> dict:
+    if not devices:
+        return {None: {0: GROUP_ID}}
+    device_groups = {}
+    seen = {}  # 録音ファイル名の接頭辞 -> group_id
+    for entry in devices:
+        group_id = str(entry["group_id"])
+        prefix = _segment_prefix(group_id, True)
+        if prefix in seen:
+            if seen[prefix] == group_id:
+                raise ValueError(f"DEVICES に同じ group_id が複数あります: {group_id}")
+            # 接頭辞が同じだと、異常終了後に復旧したファイルのグループを決められない
+            raise ValueError(f"DEVICES の group_id {seen[prefix]} と {group_id} は録音ファイル名で区別できません")
+        seen[prefix] = group_id
+        channels = device_groups.setdefault(entry.get("device_index"), {})
+        channel = int(entry.get("channel", 0))
+        if channel in channels:
+            raise ValueError(f"デバイス {entry.get('device_index')} のチャンネル {channel} が重複しています")
+        channels[channel] = group_id
+    return device_groups
 
+# 録音ファイル名の接頭辞。複数グループ録音時はグループIDを含める
+def _segment_prefix(group_id: str, multi: bool) -> str:
+    if not multi:
+        return "output"
+    return "output_" + re.sub(r"[^A-Za-z0-9-]", "-", str(group_id))
+
+# 録音関数（1つの入力デバイスを開き、チャンネルごとに別グループとして録音する）
+def record_audio(on_segment, record_seconds, stop_event=None, device_index=None, groups=None):
+    groups = groups or {0: GROUP_ID}
+    multi = groups != {0: GROUP_ID} or device_index is not None
+    channels = max(groups) + 1
+    audio = pyaudio.PyAudio()
+
+    # 録音設定（入力ストリームは開いたまま、セグメントの切り替えは SegmentRotator が行う）
+    stream = audio.open(format=FORMAT, channels=channels,
+                        rate=RATE, input=True,
+                        input_device_index=device_index,
+                        frames_per_buffer=CHUNK)
+    rotators = {
+        channel: SegmentRotator(lambda filename, group_id=group_id: on_segment(filename, group_id),
+                                CHANNELS, audio.get_sample_size(FORMAT), RATE,
+                                record_seconds, SEGMENT_MODE, OVERLAP_SECONDS,
+                                prefix=_segment_prefix(group_id, multi))
+        for channel, group_id in groups.items()
+    }
+    logging.info(f"入力デバイス {device_index if device_index is not None else '(既定)'} の録音を開始: "
+                 + ", ".join(f"ch{channel}={group_id}" for channel, group_id in groups.items()))
+    try:
+        while stop_event is None or not stop_event.is_set():
+            data = stream.read(CHUNK, exception_on_overflow=False)
+            if channels == 1:
+                rotators[0].feed(data)
+                continue
+            # 多チャンネル入力はチャンネルごとに分けて各グループへ
+            frames = np.frombuffer(data, dtype='<i2').reshape(-1, channels)
+            for channel, rotator in rotators.items():
+                rotator.feed(frames[:, channel].tobytes())
+    finally:
         # 録音終了処理
+        for rotator in rotators.values():
+            rotator.close()
         stream.stop_stream()
         stream.close()
         audio.terminate()
 
-        # ファイルに保存
-        ts = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y%m%d-%H%M%S")
-        filename = f"output_{ts}.wav"
-        waveFile = wave.open(filename, 'wb')
-        waveFile.setnchannels(CHANNELS)
-        waveFile.setsampwidth(audio.get_sample_size(FORMAT))
-        waveFile.setframerate(RATE)
-        waveFile.writeframes(b''.join(frames))
-        waveFile.close()
+# 入力デバイスの一覧を表示（DEVICES の device_index 設定用）
+def list_input_devices():
+    audio = pyaudio.PyAudio()
+    try:
+        for i in range(audio.get_device_count()):
+            info = audio.get_device_info_by_index(i)
+            if info.get("maxInputChannels", 0) > 0:
+                print(f"{i}: {info['name']} (入力 {info['maxInputChannels']} ch)")
+    finally:
+        audio.terminate()
 
-        # キューにファイル名を追加
-        q.put(filename)
+_PARTIAL_NAME = re.compile(r"^output_(?:(?P<group>.+)_)?\d{8}-\d{6}(?:_\d+)?\.wav" + re.escape(PARTIAL_SUFFIX) + "$")
+
+# 前回異常終了時に残った録音途中のファイルを修復して処理対象に戻す
+def recover_partial_recordings(on_segment, directory: str = ".", devices=DEVICES):
+    # ファイル名にはグループIDを置き換えた接頭辞が入っているので、設定から元のIDを引く
+    group_ids = {
+        _segment_prefix(group_id, True): group_id
+        for groups in load_device_groups(devices).values() for group_id in groups.values()
+    }
+    for name in sorted(os.listdir(directory)):
+        match = _PARTIAL_NAME.match(name)
+        if not match:
+            continue
+        if match.group("group") is None:
+            group_id = GROUP_ID
+        else:
+            group_id = group_ids.get(f"output_{match.group('group')}")
+            if group_id is None:
+                logging.warning(f"{name} のグループが現在の DEVICES に無いため、ファイル名の {match.group('group')} を使います")
+                group_id = match.group("group")
+        partial_path = os.path.join(directory, name)
+        try:
+            frames = repair_wav_header(partial_path)
+            if frames == 0:
+                os.remove(partial_path)
+                continue
+            filename = partial_path[:-len(PARTIAL_SUFFIX)]
+            os.replace(partial_path, filename)
+            logging.info(f"録音途中のファイルを復旧: {filename} ({frames / RATE:.1f} 秒)")
+            on_segment(filename, group_id)
+        except OSError as e:
+            logging.error(f"録音途中のファイルの復旧に失敗: {partial_path}: {e}")
+
+class SegmentQueue:
+    """録音スレッドと処理ワーカーの間の有界キュー。
+    満杯時は policy に従って待つ・最も古い項目を捨てる・ディスクへ退避する。
+    取り出し時にキューでの待ち時間と残り件数をログに出す。
+    """
 
-        # 次の録音開始までの待機時間を調整（録音時間299.8秒 + 待機0.2秒 = 5分間隔）
-        time.sleep(0.2)
+    POLICIES = ("block", "drop_oldest", "spill")
+
+    def __init__(self, maxsize: int = QUEUE_MAXSIZE, policy: str = QUEUE_OVERFLOW,
+                 spill_dir: str = SPILL_DIR, name: str = "処理待ち", on_drop=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"QUEUE_OVERFLOW は {', '.join(self.POLICIES)} のいずれかを指定してください: {policy}")
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.name = name
+        self.on_drop = on_drop
+        self._q = queue.Queue(maxsize=max(1, maxsize))
+        self._lock = threading.Lock()
+        self._spill_seq = 0
+        if policy == "spill":
+            os.makedirs(spill_dir, exist_ok=True)
+            # 前回退避したまま終了した項目を取り込む
+            self._refill()
+
+    def qsize(self) -> int:
+        return self._q.qsize() + self.spilled()
+
+    def spilled(self) -> int:
+        if self.policy != "spill":
+            return 0
+        return sum(1 for name in os.listdir(self.spill_dir) if name.endswith(".json"))
+
+    def put(self, item) -> None:
+        entry = (item, time.monotonic())
+        # 終了用の None は必ずキューに入れる
+        if item is None or self.policy == "block":
+            self._q.put(entry)
+        else:
+            with self._lock:
+                # 退避済みの項目があるうちは順序を保つため後ろに並べる
+                if self.policy == "spill" and self.spilled():
+                    self._spill(item)
+                else:
+                    try:
+                        self._q.put_nowait(entry)
+                    except queue.Full:
+                        if self.policy == "spill":
+                            self._spill(item)
+                        else:
+                            self._drop_oldest(entry)
+        depth = self.qsize()
+        METRICS.set_gauge("queue_depth", depth, queue=self.name)
+        logging.info(f"[{self.name}] キューに追加: {item} (待ち {depth} 件)")
+
+    def get(self):
+        item, enqueued_at = self._q.get()
+        if item is not None:
+            waited = time.monotonic() - enqueued_at
+            depth = self.qsize()
+            METRICS.observe("queue_wait_seconds", waited, queue=self.name)
+            METRICS.set_gauge("queue_depth", depth, queue=self.name)
+            logging.info(f"[{self.name}] キュー待ち時間: {waited:.2f} 秒 (残り {depth} 件)")
+        if self.policy == "spill":
+            with self._lock:
+                self._refill()
+        return item
+
+    def task_done(self) -> None:
+        self._q.task_done()
+
+    def _drop_oldest(self, entry) -> None:
+        try:
+            dropped, _ = self._q.get_nowait()
+            self._q.task_done()
+            METRICS.inc("queue_dropped_total", queue=self.name)
+            logging.warning(f"[{self.name}] キューが満杯のため最も古い項目を破棄: {dropped}")
+            if self.on_drop is not None:
+                self.on_drop(dropped)
+        except queue.Empty:
+            pass
+        self._q.put_nowait(entry)
+
+    def _spill(self, item) -> None:
+        self._spill_seq += 1
+        name = f"{time.time_ns():020d}-{self._spill_seq:06d}.json"
+        path = os.path.join(self.spill_dir, name)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"item": item}, f)
+        os.replace(path + ".tmp", path)
+        METRICS.inc("queue_spilled_total", queue=self.name)
+        logging.warning(f"[{self.name}] キューが満杯のためディスクに退避: {item}")
+
+    def _refill(self) -> None:
+        """キューに空きがあれば、退避した項目を古い順に戻す。"""
+        for name in sorted(n for n in os.listdir(self.spill_dir) if n.endswith(".json")):
+            if self._q.full():
+                break
+            path = os.path.join(self.spill_dir, name)
+            try:
+                with open(path) as f:
+                    item = json.load(f)["item"]
+                self._q.put_nowait((item, os.path.getmtime(path) - time.time() + time.monotonic()))
+                os.remove(path)
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(f"[{self.name}] 退避した項目の読み込みに失敗: {path}: {e}")
+
+class UploadSpool:
+    """各セグメントの処理段階を SQLite に記録するスプール。
+    段階は recorded（録音済み）→ uploaded（R2へアップロード済み）→ done（処理依頼済み）と進む。
+    無音のセグメントは recorded → silent（無音と判定済み）→ done と進み、アップロードしない。
+    失敗したジョブは指数バックオフ＋ジッタで再送を予約し、再起動後も未完了のものから再開する。
+    """
+
+    # state: queued（キュー投入済み）/ running（処理中）/ retry（再送待ち）/ done / skipped / dropped / failed
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT NOT NULL,
+            group_id TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            stage TEXT NOT NULL DEFAULT 'recorded',
+            state TEXT NOT NULL DEFAULT 'queued',
+            object_key TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL,
+            last_error TEXT,
+            metadata TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, next_attempt_at);
+    """
+
+    def __init__(self, path: str = SPOOL_PATH, base_delay: float = RETRY_BASE_SECONDS,
+                 max_delay: float = RETRY_MAX_SECONDS, max_attempts: int = RETRY_MAX_ATTEMPTS):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(self.SCHEMA)
+        # 旧バージョンで作成したDBに列を追加
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        if "metadata" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN metadata TEXT")
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    def add(self, path: str, group_id: str) -> int:
+        now = time.time()
+        cur = self._execute(
+            "INSERT INTO jobs (path, group_id, session_id, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (path, group_id, generate_session_id(group_id), now, now),
+        )
+        return cur.lastrowid
+
+    def get(self, job_id: int):
+        return self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def claim(self, job_id: int) -> bool:
+        """queued のジョブを running にする。既に処理中・完了なら False（重複投入を防ぐ）。"""
+        cur = self._execute(
+            "UPDATE jobs SET state = 'running', updated_at = ? WHERE id = ? AND state = 'queued'",
+            (time.time(), job_id),
+        )
+        return cur.rowcount == 1
+
+    def mark_uploaded(self, job_id: int, object_key: str | None, metadata: dict | None = None) -> None:
+        self._execute(
+            "UPDATE jobs SET stage = 'uploaded', object_key = ?, metadata = ?, updated_at = ? WHERE id = ?",
+            (object_key, json.dumps(metadata) if metadata else None, time.time(), job_id),
+        )
+
+    def mark_silent(self, job_id: int, metadata: dict) -> None:
+        self._execute(
+            "UPDATE jobs SET stage = 'silent', metadata = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(metadata), time.time(), job_id),
+        )
+
+    def mark_skipped(self, job_id: int, metadata: dict) -> None:
+        self._execute(
+            "UPDATE jobs SET stage = 'done', state = 'skipped', metadata = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(metadata), time.time(), job_id),
+        )
+
+    def mark_done(self, job_id: int) -> None:
+        self._execute(
+            "UPDATE jobs SET stage = 'done', state = 'done', last_error = NULL, updated_at = ? WHERE id = ?",
+            (time.time(), job_id),
+        )
+
+    def mark_dropped(self, job_id: int) -> None:
+        self._execute("UPDATE jobs SET state = 'dropped', updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def mark_lost(self, job_id: int, error: str) -> None:
+        """再送しても成功しない（録音ファイルが無い・壊れているなど）ジョブを打ち切る。"""
+        self._execute(
+            "UPDATE jobs SET state = 'failed', last_error = ?, updated_at = ? WHERE id = ?",
+            (error[:500], time.time(), job_id),
+        )
+
+    def mark_failed(self, job_id: int, error: str) -> float | None:
+        """失敗を記録して再送を予約し、待ち秒数を返す。
+        max_attempts 回失敗したジョブは再送せず failed にして None を返す。
+        """
+        job = self.get(job_id)
+        attempts = job["attempts"] + 1
+        if self.max_attempts and attempts >= self.max_attempts:
+            self._execute(
+                "UPDATE jobs SET state = 'failed', attempts = ?, next_attempt_at = NULL, last_error = ?, "
+                "updated_at = ? WHERE id = ?",
+                (attempts, error[:500], time.time(), job_id),
+            )
+            return None
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        delay *= random.uniform(0.5, 1.0)
+        self._execute(
+            "UPDATE jobs SET state = 'retry', attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? "
+            "WHERE id = ?",
+            (attempts, time.time() + delay, error[:500], time.time(), job_id),
+        )
+        return delay
+
+    def claim_due(self, now: float | None = None) -> list[int]:
+        """再送時刻を過ぎたジョブを queued に戻して返す。"""
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id FROM jobs WHERE state = 'retry' AND next_attempt_at <= ? ORDER BY next_attempt_at",
+                (now,),
+            ).fetchall()
+            ids = [row["id"] for row in rows]
+            self._db.executemany(
+                "UPDATE jobs SET state = 'queued', next_attempt_at = NULL, updated_at = ? WHERE id = ?",
+                [(now, job_id) for job_id in ids],
+            )
+        return ids
+
+    def count_by_state(self) -> dict:
+        rows = self._execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state").fetchall()
+        return {row["state"]: row["n"] for row in rows}
+
+    def resume(self) -> list[int]:
+        """前回終了時に処理中・キュー待ちだったジョブを queued に戻して返す。"""
+        with self._lock:
+            self._db.execute("UPDATE jobs SET state = 'queued', updated_at = ? WHERE state = 'running'", (time.time(),))
+            rows = self._db.execute("SELECT id FROM jobs WHERE state = 'queued' ORDER BY id").fetchall()
+        return [row["id"] for row in rows]
+
+# 再送時刻を迎えたジョブを処理キューへ戻す
+def retry_scheduler(q, spool: UploadSpool, stop_event: threading.Event, interval: float = 1.0):
+    while not stop_event.wait(interval):
+        for job_id in spool.claim_due():
+            logging.info(f"ジョブ {job_id} を再送します")
+            q.put(job_id)
 
 # データ処理関数
-def process_data(q):
+def process_data(q, spool: UploadSpool):
     while True:
-        filename = q.get()  # キューからファイル名を取得
+        job_id = q.get()  # キューからジョブIDを取得
 
-        if filename is None:
+        if job_id is None:
             break
 
         start_time = time.time()
-        logging.info(f"{filename} のデータ処理を開始")
+        if not spool.claim(job_id):
+            # 既に他のワーカーが処理中・完了済み
+            q.task_done()
+            continue
+        job = spool.get(job_id)
+        filename = job["path"]
+        group_id = job["group_id"]
+        logging.info(f"{filename} のデータ処理を開始 (ジョブ {job_id}, 段階 {job['stage']}, 試行 {job['attempts'] + 1} 回目)")
 
         try:
-            # バンドパスフィルタ適用後の音声ファイルパス
-            bandpassed_file_path = filename
-
-            # ノイズ除去（バンドパスフィルタ）
-            fs, data = wavfile.read(filename)
-            lowcut = 100.0
-            highcut = 4000.0
-            y = butter_bandpass_filter(data, lowcut, highcut, fs, order=6)
-            
-            # メモリ上のデータを一時ファイルに書き出し、元のファイル(filename)を上書きしない
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_f:
-                bandpassed_file_path = temp_f.name
-                wavfile.write(bandpassed_file_path, fs, y.astype(np.int16))
+            object_key = job["object_key"]
+            metadata = json.loads(job["metadata"]) if job["metadata"] else None
+            if job["stage"] == "recorded":
+                if not os.path.exists(filename):
+                    METRICS.inc("segments_total", result="lost")
+                    spool.mark_lost(job_id, "録音ファイルが見つかりません")
+                    logging.error(f"{filename} が見つからないためジョブ {job_id} を打ち切ります")
+                    continue
+
+                # ノイズ除去（バンドパスフィルタ）
+                METRICS.inc("recorded_bytes_total", os.path.getsize(filename))
+                try:
+                    with METRICS.timer("filter"):
+                        samples, fs = filter_segment(filename)
+                except (wave.Error, EOFError, ValueError) as e:
+                    # 壊れた・非対応の録音ファイルは何度読み直しても同じなので再送しない
+                    METRICS.inc("segments_total", result="lost")
+                    spool.mark_lost(job_id, f"{type(e).__name__}: {e}")
+                    logging.error(f"{filename} を読み込めないためジョブ {job_id} を打ち切ります: {e}")
+                    continue
+                METRICS.inc("audio_seconds_total", len(samples) / fs)
+
+                # 無音判定。無音ならアップロードせず、前後の無音は切り詰める
+                if VAD_ENABLED:
+                    with METRICS.timer("vad"):
+                        activity = detect_speech(samples, fs)
+                    metadata = activity.metadata()
+                    if activity.is_silent:
+                        logging.info(f"{filename} は無音のためアップロードをスキップします (発話率 {activity.speech_ratio:.1%})")
+                        metadata["skipped"] = True
+                    else:
+                        samples = samples[activity.start:activity.end]
+                        logging.info(f"発話率 {activity.speech_ratio:.1%}、先頭 {metadata['trimStartSeconds']} 秒・"
+                                     f"合計 {metadata['trimmedSeconds']} 秒の無音を除去")
+
+                if metadata and metadata.get("skipped"):
+                    # 無音と判定したことを記録し、通知の再送時はフィルタ・無音判定をやり直さない
+                    spool.mark_silent(job_id, metadata)
+                else:
+                    # FLAC変換をメモリ上で行う（一時ファイルを作らない）
+                    with METRICS.timer("encode"):
+                        audio_data, CONTENT_TYPE, ext = encode_audio(samples, fs)
+                    METRICS.inc("encoded_bytes_total", len(audio_data), content_type=CONTENT_TYPE)
 
-            # バンドパス後の音源をFLACへ変換
-            FILE, CONTENT_TYPE = _convert_to_flac(bandpassed_file_path)
+                    # R2 にアップロード
+                    upload_url, object_key = get_signed_upload_url(CONTENT_TYPE)
+                    upload_to_r2(upload_url, audio_data, CONTENT_TYPE)
+                    spool.mark_uploaded(job_id, object_key, metadata)
 
-            # R2 にアップロードし、処理依頼を送る
-            upload_url, object_key = get_signed_upload_url(CONTENT_TYPE)
-            upload_to_r2(upload_url, FILE, CONTENT_TYPE)
+                    # デノイズ後の音声を保存（処理依頼の再送時には不要なため、ここで手放す）
+                    try:
+                        save_file(f"{Path(filename).stem}{ext}", audio_data)
+                    except Exception as e:
+                        logging.error(f"ファイル保存エラー: {e}")
+                del samples
 
-            # セッションID生成（GROUP_ID + ホスト名 + 日付）
-            session_id = generate_session_id(GROUP_ID)
-            request_transcription(object_key, session_id, GROUP_ID)
+            # 処理依頼を送る（セッションIDはジョブ登録時に GROUP_ID + ホスト名 + 日付 で生成済み）
+            # 無音のセグメントは objectKey なし・skipped: true で通知する
+            skipped = bool(metadata and metadata.get("skipped"))
+            if not skipped or VAD_REPORT_SKIPPED:
+                request_transcription(object_key, job["session_id"], group_id, metadata)
+            if skipped:
+                spool.mark_skipped(job_id, metadata)
+                METRICS.inc("segments_total", result="skipped")
+            else:
+                spool.mark_done(job_id)
+                METRICS.inc("segments_total", result="done")
 
-            # ファイルを移動（デノイズ後のファイルを優先して移動し、元ファイルも退避）
+            # 元ファイルを退避
             try:
-                if os.path.exists(FILE):
-                    move_file(FILE)
-                if FILE!= filename and os.path.exists(filename):
+                if os.path.exists(filename):
                     move_file(filename)
             except Exception as e:
                 logging.error(f"ファイル移動エラー: {e}")
@@ -285,21 +1481,20 @@ def process_data(q):
             exception_type, exception_object, exception_traceback = sys.exc_info()
             line_number = exception_traceback.tb_lineno if exception_traceback else -1
             logging.error(f'line {line_number}: {exception_type} - {e}')
+            METRICS.inc("segments_total", result="failed")
+            delay = spool.mark_failed(job_id, f"{exception_type.__name__}: {e}")
+            if delay is None:
+                logging.error(f"ジョブ {job_id} は {spool.max_attempts} 回失敗したため再送を打ち切ります")
+            else:
+                logging.info(f"ジョブ {job_id} は {delay:.0f} 秒後に再送します")
         finally:
-            # 一時ファイルをクリーンアップ
-            if 'bandpassed_file_path' in locals() and bandpassed_file_path!= filename and os.path.exists(bandpassed_file_path):
-                try:
-                    os.remove(bandpassed_file_path)
-                except OSError as e:
-                    logging.error(f"一時ファイルの削除に失敗: {e}")
-
             elapsed_time = time.time() - start_time
+            METRICS.observe("stage_seconds", elapsed_time, stage="total")
             logging.info(f"{filename} のデータ処理時間: {elapsed_time:.2f} 秒")
             q.task_done()
             
-# 音声ファイルを指定のフォルダに移動
-def move_file(FILE):
-    source = FILE
+# 保存先フォルダでのパスを決める（同じ名前のファイルが存在する場合、ファイル名を変更）
+def _destination_path(name: str) -> str:
     destination = FOLDER_PATH
 
     # 移動先ディレクトリが存在しなければ作成
@@ -309,44 +1504,92 @@ def move_file(FILE):
         logging.error(f"移動先ディレクトリの作成に失敗: {e}")
         raise
 
-    # 移動先のディレクトリで同じ名前のファイルが存在する場合、ファイル名を変更
-    if os.path.exists(os.path.join(destination, os.path.basename(FILE))):
-        base, ext = os.path.splitext(os.path.basename(FILE))
+    if os.path.exists(os.path.join(destination, name)):
+        base, ext = os.path.splitext(name)
         i = 1
         while os.path.exists(os.path.join(destination, f"{base}_{i}{ext}")):
             i += 1
-        destination_path = os.path.join(destination, f"{base}_{i}{ext}")
-    else:
-        destination_path = os.path.join(destination, os.path.basename(FILE))
+        return os.path.join(destination, f"{base}_{i}{ext}")
+    return os.path.join(destination, name)
 
-    shutil.move(source, destination_path)
+# 音声ファイルを指定のフォルダに移動
+def move_file(FILE):
+    destination_path = _destination_path(os.path.basename(FILE))
+    shutil.move(FILE, destination_path)
     logging.info(f"ファイルを移動: {destination_path}")
 
+# メモリ上の音声データを指定のフォルダに保存
+def save_file(name: str, data: bytes):
+    destination_path = _destination_path(name)
+    with open(destination_path, "wb") as f:
+        f.write(data)
+    logging.info(f"ファイルを保存: {destination_path}")
+
 def main(start_at: str | None = None):
     if start_at:
         wait_until(start_at)
 
-    q = queue.Queue()
+    spool = UploadSpool()
+    q = SegmentQueue(on_drop=spool.mark_dropped)
+    # 前回終了時に未完了だったジョブ（ワーカー起動後にキューへ戻す）
+    pending_jobs = spool.resume()
+
+    # 録音済みのセグメントをスプールに登録して処理キューへ渡す。
+    # フィルタ・変換の間に、このセグメントのアップロードに使う署名URLを先読みしておく
+    def submit_segment(filename: str, group_id: str):
+        q.put(spool.add(filename, group_id))
+        get_api_client().prefetch_signed_urls("audio/flac")
+
+    recover_partial_recordings(submit_segment)
+
+    # 録音スレッドを作成（入力デバイスごとに1本。処理・アップロードは全グループで共有する）
+    stop_event = threading.Event()
+    record_threads = []
+    for device_index, groups in load_device_groups(DEVICES).items():
+        record_thread = threading.Thread(target=record_audio,
+                                         args=(submit_segment, RECORD_SECONDS, stop_event, device_index, groups),
+                                         name=f"record-{device_index}")
+        record_thread.daemon = True
+        record_thread.start()
+        record_threads.append(record_thread)
+
+    # データ処理スレッドを作成（PROCESS_WORKERS 本で並列に処理する）
+    process_threads = []
+    for i in range(max(1, PROCESS_WORKERS)):
+        process_thread = threading.Thread(target=process_data, args=(q, spool), name=f"process-{i + 1}")
+        process_thread.daemon = True
+        process_thread.start()
+        process_threads.append(process_thread)
+
+    # 前回終了時に未完了だったジョブを再開
+    for job_id in pending_jobs:
+        q.put(job_id)
 
-    # 録音スレッドを作成
-    record_thread = threading.Thread(target=record_audio, args=(q, RECORD_SECONDS))
-    record_thread.daemon = True
-    record_thread.start()
+    # 再送スケジューラを作成
+    retry_thread = threading.Thread(target=retry_scheduler, args=(q, spool, stop_event), daemon=True)
+    retry_thread.start()
 
-    # データ処理スレッドを作成
-    process_thread = threading.Thread(target=process_data, args=(q,))
-    process_thread.daemon = True
-    process_thread.start()
+    # メトリクスの公開・書き出し
+    METRICS.gauge_fn("spool_jobs", "state", spool.count_by_state)
+    if METRICS_PORT:
+        start_metrics_server()
+    if METRICS_LOG_PATH:
+        threading.Thread(target=metrics_logger, args=(stop_event,), name="metrics-log", daemon=True).start()
 
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         logging.info("プログラムを終了します")
-        q.put(None)
+        # 録音中のセグメントを確定させてから処理スレッドを止める
+        stop_event.set()
+        for record_thread in record_threads:
+            record_thread.join(timeout=5)
+        for _ in process_threads:
+            q.put(None)
         # スレッドの終了を待つ
-        process_thread.join()
-        # record_threadはdaemonなので、メインスレッドが終了すれば自動的に終了する
+        for process_thread in process_threads:
+            process_thread.join()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="TAサポート音声処理スクリプト")
@@ -354,7 +1597,11 @@ if __name__ == "__main__":
         "--start-at",
         help="Asia/Tokyo 時間での開始時刻。'HH:MM', 'HH:MM:SS', 'YYYY-MM-DD HH:MM', 'YYYY/MM/DD HH:MM' 形式。時間のみの場合は過去なら翌日に繰り延べ。"
     )
+    parser.add_argument("--list-devices", action="store_true", help="入力デバイスの一覧を表示して終了する")
     args = parser.parse_args()
+    if args.list_devices:
+        list_input_devices()
+        sys.exit(0)
     try:
         main(start_at=args.start_at)
     except ValueError as e:
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class TaSupportAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ta_support_app'
+
+    def ready(self):
+        from . import checks  # noqa: F401  システムチェックを登録する
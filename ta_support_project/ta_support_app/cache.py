@@ -0,0 +1,95 @@
+"""一覧・詳細取得のレスポンスキャッシュ
+
+同じ URL へのポーリングはキャッシュから返し、データが書き込まれたときだけ
+該当するエントリを無効にする。無効化はバージョン番号で行う。
+
+- group_id を完全一致で指定した問い合わせは、そのグループのバージョンをキーに含める。
+- それ以外（グループ指定なし・前方一致）の問い合わせは全体のバージョンをキーに含める。
+- 書き込みがあるとそのグループのバージョンと全体のバージョンを更新する。
+
+他のグループの書き込みでキャッシュが捨てられることはない。キャッシュのバックエンドは
+settings.CACHES の DATA_CACHE_ALIAS（既定は default）で切り替えられる。
+無効化はバックエンドが全プロセスで共有されている場合にだけ効くので、複数のワーカープロセスで
+動かすときは Redis や Memcached を使う（LocMemCache のままなら起動時のシステムチェックで警告する）。
+キーに含めるグループIDや主キーはリクエストの値なので、ハッシュにしてからキーに使う。
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+DATA_CACHE_ALIAS = getattr(settings, 'DATA_CACHE_ALIAS', 'default')
+# レスポンスをキャッシュしておく秒数（無効化されなければこの秒数で期限切れになる）
+DATA_CACHE_TIMEOUT = getattr(settings, 'DATA_CACHE_TIMEOUT', 5 * 60)
+
+ALL = '*'
+
+
+def _cache():
+    return caches[DATA_CACHE_ALIAS]
+
+
+def _digest(value):
+    # Memcached では空白・制御文字や250文字を超えるキーを使えないため、リクエスト由来の値はハッシュにする
+    return hashlib.sha256(str(value).encode('utf-8')).hexdigest()
+
+
+def _version_key(scope):
+    # group_id の検索は大文字小文字を区別しない場合があるので小文字にそろえる
+    return f"data-version:{_digest(scope.lower())}"
+
+
+def _version(group_id):
+    """バージョンを返す。キャッシュから消えていた場合は新しい値で作り直す
+
+    連番ではなく時刻を使うので、作り直した値が以前の値と重なることはない。
+    """
+    cache = _cache()
+    key = _version_key(group_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def response_key(request, group_id=None):
+    """一覧取得のキャッシュキー。group_id が None なら全体のバージョンを使う"""
+    scope = group_id if group_id else ALL
+    return f"data-list:{_digest(scope.lower())}:{_version(scope)}:{_digest(request.build_absolute_uri())}"
+
+
+def record_key(pk):
+    """詳細取得のキャッシュキー。行ごとのバージョンを含める（pk は URL の文字列ではなく int で渡す）"""
+    return f"data-record:{_digest(pk)}:{_version(_record_scope(pk))}"
+
+
+def _record_scope(pk):
+    return f"#{pk}"
+
+
+def load(key):
+    return _cache().get(key)
+
+
+def store(key, data):
+    _cache().set(key, data, DATA_CACHE_TIMEOUT)
+
+
+def invalidate(group_ids, pks=()):
+    """書き込んだ行のグループ・全体・行ごとのバージョンを更新する
+
+    トランザクション内で呼ばれた場合はコミット後に行う（コミット前の古い内容を
+    別のリクエストがキャッシュし直すのを防ぐため）。
+    """
+    group_ids = {group_id for group_id in group_ids if group_id}
+
+    scopes = group_ids | {ALL} | {_record_scope(pk) for pk in pks}
+
+    def bump():
+        now = time.time_ns()
+        _cache().set_many({_version_key(scope): now for scope in scopes}, None)
+
+    transaction.on_commit(bump)
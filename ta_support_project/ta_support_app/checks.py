@@ -0,0 +1,33 @@
+"""ta_support_app のシステムチェック"""
+from django.conf import settings
+from django.core import checks
+
+LOCMEM_BACKEND = 'django.core.cache.backends.locmem.LocMemCache'
+
+
+def _is_locmem(alias):
+    return settings.CACHES.get(alias, {}).get('BACKEND') == LOCMEM_BACKEND
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_caches(app_configs, **kwargs):
+    """プロセス間で共有する前提のキャッシュがプロセスごとの LocMemCache になっていれば警告する"""
+    from . import cache, scenario
+
+    warnings = []
+    if _is_locmem(scenario.SCENARIO_CACHE_ALIAS):
+        warnings.append(checks.Warning(
+            f"The '{scenario.SCENARIO_CACHE_ALIAS}' cache used for scenario jobs is LocMemCache.",
+            hint='Jobs submitted to one worker process are unknown to the others. '
+                 'Use a shared backend such as Redis or Memcached when running several workers.',
+            id='ta_support_app.W001',
+        ))
+    if _is_locmem(cache.DATA_CACHE_ALIAS):
+        warnings.append(checks.Warning(
+            f"The '{cache.DATA_CACHE_ALIAS}' cache used for Data responses is LocMemCache.",
+            hint='A write only invalidates the cache of the worker process that handled it, so other '
+                 'workers keep serving stale lists for up to DATA_CACHE_TIMEOUT seconds. '
+                 'Use a shared backend such as Redis or Memcached when running several workers.',
+            id='ta_support_app.W002',
+        ))
+    return warnings
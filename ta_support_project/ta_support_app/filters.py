@@ -3,7 +3,10 @@ from .models import Data
 
 class DataFilter(filters.FilterSet):
     datetime = filters.IsoDateTimeFromToRangeFilter(field_name='datetime')
+    # インデックスを使えるよう完全一致・前方一致で絞り込む
+    group_id = filters.CharFilter(field_name='group_id', lookup_expr='exact')
+    group_id_prefix = filters.CharFilter(field_name='group_id', lookup_expr='startswith')
 
     class Meta:
         model = Data
-        fields = ['datetime']
\ No newline at end of file
+        fields = ['datetime', 'group_id']
\ No newline at end of file
@@ -0,0 +1,198 @@
+"""API の負荷試験（レイテンシとスループットの計測）
+
+    python manage.py loadtest --seed                      # 試験用データを投入してから計測
+    python manage.py loadtest --requests 500 --concurrency 8
+    python manage.py loadtest --endpoints list,filter --cold   # キャッシュを使わない場合
+    python manage.py loadtest --url http://127.0.0.1:8000  # 起動中のサーバに対して計測
+    python manage.py loadtest --json result.json --max-p99-ms 200  # p99 が超えたら終了コード1
+
+既定ではプロセス内でリクエストを処理し、1リクエストあたりの SQL 発行数も表示する。
+generate_scenario は OpenAI を呼ばず、--openai-latency-ms だけ待つ代わりのクライアントで計測する。
+代わりのクライアントはこのプロセスの中でしか使えないので、--url では既定で scenario を計測しない
+（--endpoints で明示した場合は、サーバに設定された OpenAI（OPEN_AI_BASE_URL）が呼ばれる）。
+--seed は設定中のデータベースに行を追加するので、本番のデータベースでは使わないこと。
+"""
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+
+from ta_support_app import cache, scenario, seeding
+from ta_support_app.models import Data
+from ta_support_app.openai_stub import FakeOpenAI
+
+ENDPOINTS = ['list', 'summary', 'filter', 'search', 'retrieve', 'changes', 'aggregate', 'rollups', 'scenario']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = 'DataViewSet の各エンドポイントのレイテンシとスループットを計測する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints',
+                            help=f'計測するエンドポイント（カンマ区切り、省略時はすべて。--url では scenario を除く）: '
+                                 f'{",".join(ENDPOINTS)}')
+        parser.add_argument('--requests', type=int, default=200, help='エンドポイントごとのリクエスト数')
+        parser.add_argument('--concurrency', type=int, default=4, help='同時に送るリクエスト数')
+        parser.add_argument('--cold', action='store_true', help='リクエストごとにレスポンスキャッシュを消す（プロセス内のみ）')
+        parser.add_argument('--url', help='起動中のサーバのURL（省略時はプロセス内で処理する）')
+        parser.add_argument('--openai-latency-ms', type=float, default=500, help='代わりの OpenAI クライアントの応答時間')
+        parser.add_argument('--seed', action='store_true', help='計測の前に試験用データを投入する')
+        parser.add_argument('--groups', type=int, default=10)
+        parser.add_argument('--days', type=int, default=60)
+        parser.add_argument('--hours-per-day', type=int, default=6)
+        parser.add_argument('--json', help='結果を JSON で保存するパス')
+        parser.add_argument('--max-p99-ms', type=float, help='p99 がこの値を超えるエンドポイントがあれば失敗とする')
+
+    def handle(self, *args, **options):
+        if options['endpoints']:
+            endpoints = [name for name in options['endpoints'].split(',') if name]
+        elif options['url']:
+            # 起動中のサーバは本物の OpenAI を呼ぶので、明示しない限り計測しない
+            endpoints = [name for name in ENDPOINTS if name != 'scenario']
+        else:
+            endpoints = ENDPOINTS
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+        if options['seed']:
+            started = time.perf_counter()
+            count = seeding.seed_data(options['groups'], options['days'], options['hours_per_day'])
+            self.stdout.write(f"{count} 行を投入しました（{time.perf_counter() - started:.1f} 秒）")
+
+        first = Data.objects.order_by('datetime', 'id').first()
+        if first is None:
+            raise CommandError('Data が空です。--seed を付けて実行してください。')
+        latest = Data.objects.aggregate(latest=Max('datetime'), latest_id=Max('id'))
+        day = timezone.localdate(latest['latest']).isoformat()
+        requests = {
+            'list': ('get', '/api/data/', {}),
+            'summary': ('get', '/api/data/', {'view': 'summary'}),
+            'filter': ('get', '/api/data/', {'group_id': first.group_id, 'datetime_after': f'{day}T00:00:00'}),
+            'search': ('get', '/api/data/', {'search': first.group_id}),
+            'retrieve': ('get', f'/api/data/{first.id}/', {}),
+            'changes': ('get', '/api/data/changes/', {'since': latest['latest_id'] - 10}),
+            'aggregate': ('get', '/api/data/aggregate/', {'interval': 'hour', 'datetime_after': f'{day}T00:00:00'}),
+            'rollups': ('get', '/api/rollups/', {'session_date': day}),
+            'scenario': ('post', '/api/data/generate_scenario/', {'group_id': first.group_id,
+                                                                    'datetime_after': f'{day}T00:00:00'}),
+        }
+
+        if options['url']:
+            send = self._http_sender(options['url'])
+            if 'scenario' in endpoints:
+                self.stderr.write('scenario はサーバに設定された OpenAI を呼び出します（代わりのクライアントは使われません）')
+        else:
+            send = self._local_sender()
+
+        rows = []
+        with mock.patch.object(scenario, 'client', FakeOpenAI(latency=options['openai_latency_ms'] / 1000)):
+            for name in endpoints:
+                rows.append(self._measure(name, requests[name], send, options))
+
+        self._print_table(rows)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(rows, f, indent=2)
+
+        limit = options['max_p99_ms']
+        if limit is not None:
+            slow = [row['endpoint'] for row in rows if row['p99_ms'] > limit]
+            if slow:
+                raise CommandError(f"p99 が {limit:.0f} ms を超えました: {', '.join(slow)}")
+
+    def _local_sender(self):
+        from rest_framework.test import APIClient
+
+        # testserver を ALLOWED_HOSTS に加える
+        setup_test_environment()
+        local = threading.local()
+
+        def send(method, path, params):
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = APIClient()
+            with CaptureQueriesContext(connection) as captured:
+                if method == 'get':
+                    response = client.get(path, params)
+                else:
+                    response = client.post(path, params, format='json')
+            return response.status_code, len(captured.captured_queries)
+        return send
+
+    def _http_sender(self, base_url):
+        import requests
+
+        local = threading.local()
+
+        def send(method, path, params):
+            session = getattr(local, 'session', None)
+            if session is None:
+                session = local.session = requests.Session()
+            if method == 'get':
+                response = session.get(base_url.rstrip('/') + path, params=params)
+            else:
+                response = session.post(base_url.rstrip('/') + path, json=params)
+            return response.status_code, None
+        return send
+
+    def _measure(self, name, request, send, options):
+        method, path, params = request
+        cold = options['cold'] and not options['url']
+        errors = []
+
+        def once(_):
+            if cold:
+                caches[cache.DATA_CACHE_ALIAS].clear()
+            started = time.perf_counter()
+            status_code, queries = send(method, path, params)
+            elapsed = time.perf_counter() - started
+            if status_code >= 400:
+                errors.append(status_code)
+            return elapsed, queries
+
+        # 1回目（キャッシュ作成や接続確立）は計測に含めない
+        once(None)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            results = list(pool.map(once, range(options['requests'])))
+        wall = time.perf_counter() - started
+        connection.close()
+
+        latencies = [elapsed * 1000 for elapsed, _ in results]
+        queries = [count for _, count in results if count is not None]
+        return {
+            'endpoint': name,
+            'requests': len(results),
+            'errors': len(errors),
+            'p50_ms': percentile(latencies, 50),
+            'p90_ms': percentile(latencies, 90),
+            'p99_ms': percentile(latencies, 99),
+            'rps': len(results) / wall,
+            'queries': statistics.mean(queries) if queries else None,
+        }
+
+    def _print_table(self, rows):
+        header = f"{'endpoint':<11}{'reqs':>6}{'err':>5}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'req/s':>9}{'queries':>9}"
+        self.stdout.write(header)
+        self.stdout.write("-" * len(header))
+        for row in rows:
+            queries = f"{row['queries']:.1f}" if row['queries'] is not None else '-'
+            self.stdout.write(
+                f"{row['endpoint']:<11}{row['requests']:>6}{row['errors']:>5}{row['p50_ms']:>9.2f}"
+                f"{row['p90_ms']:>9.2f}{row['p99_ms']:>9.2f}{row['rps']:>9.1f}{queries:>9}")
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.6 on 2026-10-17 18:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ta_support_app', '0004_alter_data_transcript_alter_data_transcript_diarize'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='data',
+            index=models.Index(fields=['group_id', 'datetime'], name='data_group_datetime_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='data',
+            index=models.Index(fields=['datetime'], name='data_datetime_idx'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.0.6 on 2026-10-17 18:18
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_rollups(apps, schema_editor):
+    """既存の Data からグループ・日ごとの集計を作る"""
+    Data = apps.get_model('ta_support_app', 'Data')
+    GroupSessionRollup = apps.get_model('ta_support_app', 'GroupSessionRollup')
+    totals = (
+        Data.objects
+        .annotate(session_date=TruncDate('datetime'))
+        .values('group_id', 'session_date')
+        .annotate(
+            segment_count=Count('id'),
+            utterance_sum=Sum('utterance_count'),
+            sentiment_sum=Sum('sentiment_value'),
+            sentiment_min=Min('sentiment_value'),
+            sentiment_max=Max('sentiment_value'),
+            first_datetime=Min('datetime'),
+            last_datetime=Max('datetime'),
+        )
+        .order_by('group_id', 'session_date')
+    )
+    GroupSessionRollup.objects.bulk_create(
+        (GroupSessionRollup(**row) for row in totals.iterator()),
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ta_support_app', '0006_ingestbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupSessionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group_id', models.CharField(max_length=10)),
+                ('session_date', models.DateField()),
+                ('segment_count', models.IntegerField(default=0)),
+                ('utterance_sum', models.IntegerField(default=0)),
+                ('sentiment_sum', models.FloatField(default=0)),
+                ('sentiment_min', models.FloatField(null=True)),
+                ('sentiment_max', models.FloatField(null=True)),
+                ('first_datetime', models.DateTimeField(null=True)),
+                ('last_datetime', models.DateTimeField(null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['session_date'], name='rollup_session_date_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='groupsessionrollup',
+            constraint=models.UniqueConstraint(fields=('group_id', 'session_date'), name='rollup_group_date_uniq'),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -10,5 +10,53 @@ class Data(models.Model):
     sentiment_value = models.FloatField()
     datetime = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # グループ指定＋期間指定の検索（ダッシュボードの主な問い合わせ）
+            models.Index(fields=['group_id', 'datetime'], name='data_group_datetime_idx'),
+            # グループを指定しない期間指定の検索
+            models.Index(fields=['datetime'], name='data_datetime_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.group_id}"
+
+
+class IngestBatch(models.Model):
+    """一括登録（bulk）で処理済みの冪等キー。同じキーで再送されたバッチは登録しない"""
+    key = models.CharField(max_length=64, unique=True)
+    row_count = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.key}"
+
+
+class GroupSessionRollup(models.Model):
+    """グループ・日ごとの集計値。Data の書き込みに合わせて更新する（rollups.py）"""
+    group_id = models.CharField(max_length=10)
+    session_date = models.DateField()
+    segment_count = models.IntegerField(default=0)
+    utterance_sum = models.IntegerField(default=0)
+    sentiment_sum = models.FloatField(default=0)
+    sentiment_min = models.FloatField(null=True)
+    sentiment_max = models.FloatField(null=True)
+    first_datetime = models.DateTimeField(null=True)
+    last_datetime = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['group_id', 'session_date'], name='rollup_group_date_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['session_date'], name='rollup_session_date_idx'),
+        ]
+
+    @property
+    def sentiment_avg(self):
+        if not self.segment_count:
+            return None
+        return self.sentiment_sum / self.segment_count
+
     def __str__(self):
-        return f"{self.group_id}"
\ No newline at end of file
+        return f"{self.group_id} {self.session_date}"
\ No newline at end of file
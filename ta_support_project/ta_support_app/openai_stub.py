@@ -0,0 +1,74 @@
+"""OpenAI クライアントの代わり（テストと loadtest コマンドで使う）
+
+ネットワークに接続せずに generate_scenario を動かすためのもの。
+scenario.client / scenario.async_client を差し替えて使う。
+"""
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+
+class FakeOpenAI:
+    """OpenAI クライアントの代わり。呼び出された回数とプロンプトを記録する
+
+    latency を指定すると、応答を返す前にその秒数だけ待つ（負荷試験で OpenAI の応答時間を模す）。
+    """
+
+    def __init__(self, text="・声掛けシナリオ", chunks=3, latency=0):
+        self.text = text
+        self.chunks = chunks
+        self.latency = latency
+        self.prompts = []
+        self.closed = 0
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, stream=False):
+        with self.lock:
+            self.prompts.append(messages[0]["content"])
+        if self.latency:
+            time.sleep(self.latency)
+        if stream:
+            return FakeStream(self, [self.text] * self.chunks)
+        message = SimpleNamespace(content=self.text)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class FakeStream:
+    def __init__(self, client, parts):
+        self.client = client
+        self.parts = parts
+
+    def __iter__(self):
+        for part in self.parts:
+            delta = SimpleNamespace(content=part)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    def close(self):
+        self.client.closed += 1
+
+
+class FakeAsyncOpenAI:
+    """AsyncOpenAI の代わり。ストリームは最初のトークンを返したあと、止められるまで待ち続ける"""
+
+    def __init__(self, text="・声掛けシナリオ"):
+        self.text = text
+        self.closed = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, stream=False):
+        return FakeAsyncStream(self, self.text)
+
+
+class FakeAsyncStream:
+    def __init__(self, client, text):
+        self.client = client
+        self.text = text
+
+    async def __aiter__(self):
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=self.text))])
+        await asyncio.Event().wait()
+
+    async def close(self):
+        self.client.closed += 1
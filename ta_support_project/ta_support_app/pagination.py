@@ -0,0 +1,14 @@
+from rest_framework.pagination import CursorPagination
+
+
+class DataCursorPagination(CursorPagination):
+    """(datetime, id) 順のカーソルページネーション
+
+    OFFSET を使わず直前のページ末尾の位置から読み進めるため、テーブルが大きくなっても
+    1回の問い合わせはインデックスに沿った page_size 件の読み込みで済む。
+    datetime が同じ行があっても id で順序が一意に決まる。
+    """
+    ordering = ('datetime', 'id')
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
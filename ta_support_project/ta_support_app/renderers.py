@@ -0,0 +1,69 @@
+import csv
+import io
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.renderers import BaseRenderer
+
+
+def sse_event(data, event=None):
+    """1件分の Server-Sent Events のメッセージを組み立てる（data は JSON にする）"""
+    message = f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    if event:
+        message = f"event: {event}\n" + message
+    return message.encode('utf-8')
+
+
+class EventStreamRenderer(BaseRenderer):
+    """text/event-stream を受け付けるためのレンダラ
+
+    ストリーミングの本体は StreamingHttpResponse で返す。このレンダラは
+    入力エラーなど通常の Response を error イベントとして返すときに使われる。
+    """
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return sse_event(data, event='error')
+
+
+
+def ndjson_line(record):
+    """1件分の NDJSON の行（日時は ISO 8601 の文字列にする）"""
+    return (json.dumps(record, ensure_ascii=False, cls=DjangoJSONEncoder) + "\n").encode('utf-8')
+
+
+def csv_line(values):
+    """1行分の CSV（RFC 4180 の引用規則に従う）"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue().encode('utf-8')
+
+
+class NDJSONRenderer(BaseRenderer):
+    """application/x-ndjson。エクスポート本体は StreamingHttpResponse で返し、
+    このレンダラは入力エラーなど通常の Response を1行の JSON として返すときに使われる
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return ndjson_line(data)
+
+
+class CSVRenderer(BaseRenderer):
+    """text/csv。エラー時は内容を1列の CSV として返す"""
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return csv_line([json.dumps(data, ensure_ascii=False)])
\ No newline at end of file
@@ -0,0 +1,70 @@
+"""グループ・日ごとの集計（GroupSessionRollup）の更新
+
+Data の行が追加されたときは該当する集計に差分を加える。変更・削除・一括登録の
+ときは、影響するグループ・日の行だけを集計し直す。
+"""
+import datetime
+
+from django.db import transaction
+from django.db.models import Count, Max, Min, Sum
+from django.utils import timezone
+
+from .models import Data, GroupSessionRollup
+
+
+def session_date(value):
+    """行の日時からセッションの日付（ローカル時刻の日付）を求める"""
+    return timezone.localdate(value)
+
+
+def _day_range(date):
+    start = timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+    return start, start + datetime.timedelta(days=1)
+
+
+def record_created(instance):
+    """追加された1行分を集計に加える"""
+    date = session_date(instance.datetime)
+    with transaction.atomic():
+        rollup, _ = (
+            GroupSessionRollup.objects
+            .select_for_update()
+            .get_or_create(group_id=instance.group_id, session_date=date)
+        )
+        rollup.segment_count += 1
+        rollup.utterance_sum += instance.utterance_count
+        rollup.sentiment_sum += instance.sentiment_value
+        if rollup.sentiment_min is None or instance.sentiment_value < rollup.sentiment_min:
+            rollup.sentiment_min = instance.sentiment_value
+        if rollup.sentiment_max is None or instance.sentiment_value > rollup.sentiment_max:
+            rollup.sentiment_max = instance.sentiment_value
+        if rollup.first_datetime is None or instance.datetime < rollup.first_datetime:
+            rollup.first_datetime = instance.datetime
+        if rollup.last_datetime is None or instance.datetime > rollup.last_datetime:
+            rollup.last_datetime = instance.datetime
+        rollup.save()
+
+
+def recompute(group_id, date):
+    """1つのグループ・日の集計を Data から作り直す。行がなくなった場合は集計も消す"""
+    start, end = _day_range(date)
+    totals = Data.objects.filter(group_id=group_id, datetime__gte=start, datetime__lt=end).aggregate(
+        segment_count=Count('id'),
+        utterance_sum=Sum('utterance_count'),
+        sentiment_sum=Sum('sentiment_value'),
+        sentiment_min=Min('sentiment_value'),
+        sentiment_max=Max('sentiment_value'),
+        first_datetime=Min('datetime'),
+        last_datetime=Max('datetime'),
+    )
+    if not totals['segment_count']:
+        GroupSessionRollup.objects.filter(group_id=group_id, session_date=date).delete()
+        return
+    GroupSessionRollup.objects.update_or_create(group_id=group_id, session_date=date, defaults=totals)
+
+
+def recompute_for(records):
+    """records（Data）が属するグループ・日の集計をそれぞれ作り直す"""
+    keys = {(record.group_id, session_date(record.datetime)) for record in records}
+    for group_id, date in sorted(keys):
+        recompute(group_id, date)
@@ -0,0 +1,438 @@
+"""指導シナリオ生成（OpenAI）の実行・キャッシュ・重複排除
+
+同じプロンプトの結果は Django のキャッシュに保存し、有効期間内は OpenAI を呼ばずに返す。
+生成中の同じプロンプトへの依頼は1回の呼び出しにまとめ、結果を共有する。
+生成はスレッドプールで行うので、リクエストを処理するワーカーを待たせずに
+ジョブIDを返し、後から結果を取りに来ることもできる。
+
+プロンプトの長さは会議の長さによらず一定以下に抑える。グループIDを指定した場合は
+直近の文字起こしだけをそのまま使い、それより前の内容は時刻の区切り（既定は30分）ごとに
+積み重ねた要約（キャッシュする）にまとめる。対象は既定で当日分だけにし、1回の生成で新たに
+作る要約の数にも上限を設けるので、OpenAI の呼び出し回数は会議の長さによらない。
+要約はジョブ（またはストリーム）の中で作り、同じ区切りの要約を同時に作ろうとした依頼は
+1回の呼び出しにまとめる。
+
+ジョブの状態（生成中・完了・失敗）はキャッシュに記録するので、複数のワーカープロセスで
+動かす場合は SCENARIO_CACHE_ALIAS に Redis や Memcached などの共有バックエンドが必要になる
+（LocMemCache のままだと、別のプロセスで受け付けたジョブを問い合わせると unknown になる。
+起動時のシステムチェックで警告する）。生成中の依頼を1回にまとめるのはプロセス内だけで行う。
+"""
+import datetime
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from openai import AsyncOpenAI, OpenAI
+
+from .models import Data
+
+logger = logging.getLogger(__name__)
+
+SCENARIO_MODEL = getattr(settings, 'SCENARIO_MODEL', 'gpt-4o-mini')
+# 生成結果をキャッシュしておく秒数
+SCENARIO_CACHE_TIMEOUT = getattr(settings, 'SCENARIO_CACHE_TIMEOUT', 60 * 60)
+# 失敗した結果を覚えておく秒数（ポーリングしているクライアントに失敗を伝えるため）
+SCENARIO_ERROR_TIMEOUT = getattr(settings, 'SCENARIO_ERROR_TIMEOUT', 60)
+# 生成中の印を残しておく最大秒数（プロセスが落ちて印が消されなかった場合に備える）
+SCENARIO_PENDING_TIMEOUT = getattr(settings, 'SCENARIO_PENDING_TIMEOUT', 10 * 60)
+SCENARIO_CACHE_ALIAS = getattr(settings, 'SCENARIO_CACHE_ALIAS', 'default')
+# OpenAI を同時に呼び出す最大数
+SCENARIO_WORKERS = getattr(settings, 'SCENARIO_WORKERS', 4)
+# プロンプトにそのまま含める直近の文字起こしの行数（1行=1セグメント）
+SCENARIO_RECENT_ROWS = getattr(settings, 'SCENARIO_RECENT_ROWS', 6)
+# 古い文字起こしを要約する区切りの分数（ローカル時刻の0時から数える。1440 を割り切れる値にする）
+SCENARIO_SUMMARY_MINUTES = getattr(settings, 'SCENARIO_SUMMARY_MINUTES', 30)
+# 1回の生成で新たに要約を作る最大回数（超える分は古い区切りをまとめて1回で要約する）
+SCENARIO_MAX_SUMMARY_CHUNKS = getattr(settings, 'SCENARIO_MAX_SUMMARY_CHUNKS', 4)
+# プロンプトに含める文字起こし・要約の最大文字数（超えた分は古い側から切り捨てる）
+SCENARIO_MAX_TRANSCRIPT_CHARS = getattr(settings, 'SCENARIO_MAX_TRANSCRIPT_CHARS', 6000)
+SCENARIO_MAX_SUMMARY_CHARS = getattr(settings, 'SCENARIO_MAX_SUMMARY_CHARS', 2000)
+# 要約は同じ行の組み合わせなら変わらないので長めに保持する
+SCENARIO_SUMMARY_CACHE_TIMEOUT = getattr(settings, 'SCENARIO_SUMMARY_CACHE_TIMEOUT', 24 * 60 * 60)
+
+# OpenAI 互換のAPIサーバ（検証用のローカルサーバなど）を使う場合に指定する
+OPEN_AI_BASE_URL = getattr(settings, 'OPEN_AI_BASE_URL', None)
+
+client = OpenAI(api_key=settings.OPEN_AI_API_KEY, base_url=OPEN_AI_BASE_URL)
+# ASGI で動かすときのストリーミング用（イベントループ上でトークンを受け取る）
+async_client = AsyncOpenAI(api_key=settings.OPEN_AI_API_KEY, base_url=OPEN_AI_BASE_URL)
+
+PROMPT_HEADER = "#命令文:\nあなたは優秀な教員です。以降に示すグループワークの内容を見て、このグループに対してどのように声を掛け指導を開始しますか？指導の際の声掛けシナリオを箇条書きで複数提示してください。その際、グループの議論を活性化させることに焦点を置いてください。\n"
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+UNKNOWN = 'unknown'
+
+
+SUMMARY_PROMPT_HEADER = "#命令文:\n以下はグループワークの議論の記録です。これまでの要約と新しい記録をあわせて、議論の流れ、主な論点、各話者の関わり方が分かるように400字程度で要約してください。\n"
+
+TRUNCATED_MARK = "（前略）\n"
+
+
+def truncate_transcript(text, max_chars=SCENARIO_MAX_TRANSCRIPT_CHARS):
+    """最大文字数を超える場合は古い側（先頭）を切り捨てて直近の内容を残す"""
+    if len(text) <= max_chars:
+        return text
+    return TRUNCATED_MARK + text[len(text) - max_chars:]
+
+
+def build_prompt(transcript, summary=None):
+    prompt = PROMPT_HEADER
+    if summary:
+        prompt += "#これまでの議論の要約:\n" + summary + "\n"
+    return prompt + "#グループワークの内容:\n" + truncate_transcript(transcript)
+
+
+def scenario_key(prompt, model=SCENARIO_MODEL):
+    """モデル名とプロンプトの内容から求めるキャッシュキー（ジョブIDとしても使う）"""
+    text = prompt.identity if isinstance(prompt, GroupPrompt) else prompt
+    return hashlib.sha256(f"{model}\n{text}".encode('utf-8')).hexdigest()
+
+
+def _cache():
+    return caches[SCENARIO_CACHE_ALIAS]
+
+
+def _result_key(key):
+    return f"scenario:{key}"
+
+
+def _error_key(key):
+    return f"scenario-error:{key}"
+
+
+def _pending_key(key):
+    return f"scenario-pending:{key}"
+
+
+def complete(prompt, model=SCENARIO_MODEL):
+    """OpenAI にシナリオ生成を依頼し、生成されたテキストを返す"""
+    completion = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "user", "content": prompt}
+        ])
+    return completion.choices[0].message.content
+
+
+def stream(prompt, model=SCENARIO_MODEL):
+    """生成されたテキストを届いた順に少しずつ返すジェネレータ（WSGI 用）
+
+    キャッシュ済みならその結果を一度に返す。最後まで受け取れた結果はキャッシュする。
+    途中で close() された（クライアントが切断した）場合は上流のストリームも閉じ、
+    それ以上トークンを消費しない。ASGI では同期ジェネレータは最後まで読み切ってから
+    送られるので astream() を使う。
+    """
+    key = scenario_key(prompt, model)
+    cached = _cache().get(_result_key(key))
+    if cached is not None:
+        yield cached
+        return
+
+    # 要約はレスポンスを返し始めてから作る
+    response = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "user", "content": resolve_prompt(prompt)}
+        ],
+        stream=True)
+    parts = []
+    try:
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+    finally:
+        response.close()
+    _cache().set(_result_key(key), ''.join(parts), SCENARIO_CACHE_TIMEOUT)
+
+
+async def astream(prompt, model=SCENARIO_MODEL):
+    """stream() の非同期版（ASGI 用）
+
+    クライアントが切断すると Django がこのジェネレータを止める（CancelledError か aclose()）ので、
+    finally で上流のストリームを閉じる。
+    """
+    key = scenario_key(prompt, model)
+    cached = await _cache().aget(_result_key(key))
+    if cached is not None:
+        yield cached
+        return
+
+    # 要約は同期の OpenAI クライアントで作るので、イベントループを止めないよう別スレッドで行う
+    text = await sync_to_async(resolve_prompt, thread_sensitive=False)(prompt)
+    response = await async_client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "user", "content": text}
+        ],
+        stream=True)
+    parts = []
+    try:
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+    finally:
+        await response.close()
+    await _cache().aset(_result_key(key), ''.join(parts), SCENARIO_CACHE_TIMEOUT)
+
+
+def _format_rows(rows):
+    lines = []
+    for row in rows:
+        text = row.transcript_diarize or row.transcript or ''
+        lines.append(f"[{timezone.localtime(row.datetime):%H:%M}]\n{text}")
+    return "\n".join(lines)
+
+
+def _slot_start(value):
+    """value を含む要約の区切りの開始時刻"""
+    local = timezone.localtime(value)
+    minutes = local.hour * 60 + local.minute
+    midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    return midnight + datetime.timedelta(minutes=minutes - minutes % SCENARIO_SUMMARY_MINUTES)
+
+
+def _summary_key(group_id, start, end):
+    # 区切りの開始時刻 start から end までを積み重ねた要約。
+    # group_id はリクエストの値なので、Memcached でも使えるようハッシュにする
+    group = hashlib.sha256(str(group_id).encode('utf-8')).hexdigest()
+    return f"scenario-summary:{group}:{int(start.timestamp())}:{int(end.timestamp())}"
+
+
+def _summarize(key, summary, text):
+    """これまでの要約に1区切り分の記録を加えた要約を作ってキャッシュする"""
+    cached = _cache().get(key)
+    if cached is not None:
+        return cached
+    prompt = SUMMARY_PROMPT_HEADER
+    if summary:
+        prompt += "#これまでの要約:\n" + summary + "\n"
+    prompt += "#新しい記録:\n" + truncate_transcript(text)
+    summary = truncate_transcript(complete(prompt), SCENARIO_MAX_SUMMARY_CHARS)
+    _cache().set(key, summary, SCENARIO_SUMMARY_CACHE_TIMEOUT)
+    return summary
+
+
+class GroupPrompt:
+    """グループの文字起こしから組み立てるプロンプト
+
+    DB から読む部分（load_group_prompt）と、要約を作ってプロンプトにする部分（build）を分ける。
+    build は OpenAI を呼ぶので、リクエストを処理するスレッドではなくジョブやストリームの中で呼ぶ。
+    identity は要約前の内容を表す文字列で、キャッシュキー（ジョブID）の計算に使う。
+    """
+
+    def __init__(self, group_id, start, summary, chunks, recent, identity):
+        self.group_id = group_id
+        self.start = start      # 要約を積み重ね始める区切りの開始時刻
+        self.summary = summary  # キャッシュ済みの最も新しい区切りまでの要約
+        self.chunks = chunks    # まだ要約していない区切り [(区切りの終わりの時刻, 記録)]
+        self.recent = recent
+        self.identity = identity
+
+    def build(self):
+        """区切りごとに要約を積み重ね、シナリオ生成用のプロンプトを返す
+
+        同じ区切りの要約を同時に作ろうとした依頼は、先に始めた方の結果を待って使う。
+        """
+        summary = self.summary
+        for end, text in self.chunks:
+            key = _summary_key(self.group_id, self.start, end)
+            summary = jobs.shared(key, lambda key=key, summary=summary, text=text: _summarize(key, summary, text))
+        return build_prompt(self.recent, summary)
+
+
+def resolve_prompt(prompt):
+    """GroupPrompt なら要約を作ってプロンプトの文字列にする"""
+    return prompt.build() if isinstance(prompt, GroupPrompt) else prompt
+
+
+def load_group_prompt(group_id, datetime_after=None, datetime_before=None):
+    """グループの文字起こしを読み込み、シナリオ生成用の GroupPrompt を返す
+
+    datetime_after を省略した場合は当日（datetime_before を指定した場合はその日）の0時からとする。
+    直近 SCENARIO_RECENT_ROWS 行を含む区切りからの行はそのまま含め、それより前の行は
+    SCENARIO_SUMMARY_MINUTES 分の区切りごとに要約を積み重ねる。区切りは行IDではなく時刻で決め、
+    範囲の開始も区切りの開始時刻に切り下げるので、datetime_after を少しずらしても、
+    会議が進んでも、キャッシュ済みの要約はそのまま使える。まだ要約していない区切りが
+    SCENARIO_MAX_SUMMARY_CHUNKS を超える場合（キャッシュが空のときなど）は、古い区切りを
+    まとめて1回で要約する。該当する行がなければ None を返す。
+    """
+    if datetime_after is None:
+        day = timezone.localtime(datetime_before) if datetime_before is not None else timezone.localtime()
+        datetime_after = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = _slot_start(datetime_after)
+    queryset = Data.objects.filter(group_id=group_id, datetime__gte=start)
+    if datetime_before is not None:
+        queryset = queryset.filter(datetime__lte=datetime_before)
+    fields = ('id', 'datetime', 'transcript', 'transcript_diarize')
+
+    rows = list(queryset.order_by('datetime', 'id').values_list('id', 'datetime'))
+    if not rows:
+        return None
+
+    # 要約するのは直近の行を含む区切りより前の区切りだけにして、要約の対象が毎回変わらないようにする
+    cut = _slot_start(rows[max(len(rows) - SCENARIO_RECENT_ROWS, 0)][1])
+    step = datetime.timedelta(minutes=SCENARIO_SUMMARY_MINUTES)
+    chunks = []  # [(区切りの終わりの時刻, [行ID])]
+    older = 0
+    for pk, at in rows:
+        if at >= cut:
+            break
+        end = _slot_start(at) + step
+        if chunks and chunks[-1][0] == end:
+            chunks[-1][1].append(pk)
+        else:
+            chunks.append((end, [pk]))
+        older += 1
+    older_ids = [pk for pk, _ in rows[:older]]
+
+    # キャッシュに残っている最も新しい区切りまでの要約から続ける
+    summary = None
+    done = 0
+    if chunks:
+        keys = [_summary_key(group_id, start, end) for end, _ in chunks]
+        cached = _cache().get_many(keys)
+        for index in range(len(chunks) - 1, -1, -1):
+            if keys[index] in cached:
+                summary = cached[keys[index]]
+                done = index + 1
+                break
+
+    pending = chunks[done:]
+    limit = max(SCENARIO_MAX_SUMMARY_CHUNKS, 1)
+    if len(pending) > limit:
+        # 古い区切りは1回でまとめて要約する（記録は truncate_transcript で新しい側が残る）
+        folded = len(pending) - limit + 1
+        pending = [(pending[folded - 1][0], [pk for _, ids in pending[:folded] for pk in ids])] + pending[folded:]
+
+    # まだ要約していない区切りの行はまとめて1回で読む
+    texts = []
+    if pending:
+        ids = [pk for _, chunk in pending for pk in chunk]
+        loaded = {row.id: row for row in queryset.filter(id__in=ids).only(*fields)}
+        texts = [(end, _format_rows(loaded[pk] for pk in chunk if pk in loaded)) for end, chunk in pending]
+
+    recent_ids = [pk for pk, _ in rows[older:]]
+    recent = _format_rows(queryset.filter(id__in=recent_ids).only(*fields).order_by('datetime', 'id'))
+    older_digest = hashlib.sha256(','.join(map(str, older_ids)).encode('utf-8')).hexdigest()
+    identity = f"group:{group_id}\n{int(start.timestamp())}\n{older_digest}\n{recent}"
+    return GroupPrompt(group_id, start, summary, texts, recent, identity)
+
+
+class ScenarioJobs:
+    """シナリオ生成ジョブの管理。同じキーの生成中ジョブは1つの Future を共有する"""
+
+    def __init__(self, max_workers=SCENARIO_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scenario')
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._shared = {}
+
+    def _run(self, key, prompt, model):
+        try:
+            scenario = complete(resolve_prompt(prompt), model)
+        except Exception as e:
+            logger.warning('Error generating scenario: %s', e)
+            _cache().set(_error_key(key), str(e), SCENARIO_ERROR_TIMEOUT)
+            raise
+        else:
+            _cache().set(_result_key(key), scenario, SCENARIO_CACHE_TIMEOUT)
+            _cache().delete(_error_key(key))
+            return scenario
+        finally:
+            _cache().delete(_pending_key(key))
+
+    def shared(self, key, fn):
+        """同じキーの処理が実行中ならその結果を待ち、なければ呼び出したスレッドで fn を実行する
+
+        ジョブの中から呼ばれるので、スレッドプールには投入しない（空きを待ち合って止まらないように）。
+        """
+        with self._lock:
+            future = self._shared.get(key)
+            owner = future is None
+            if owner:
+                future = self._shared[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._shared[key]
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def submit(self, prompt, model=SCENARIO_MODEL):
+        """生成を依頼して (キー, Future) を返す。キャッシュ済みなら Future は None
+
+        prompt には文字列か GroupPrompt を渡す。GroupPrompt の要約はジョブの中で作る。
+        """
+        key = scenario_key(prompt, model)
+        if _cache().get(_result_key(key)) is not None:
+            return key, None
+        with self._lock:
+            future = self._inflight.get(key)
+            created = future is None
+            if created:
+                # 他のプロセスで状態を問い合わせても生成中と分かるよう、キャッシュに印を残す
+                _cache().set(_pending_key(key), True, SCENARIO_PENDING_TIMEOUT)
+                future = self._executor.submit(self._run, key, prompt, model)
+                self._inflight[key] = future
+        if created:
+            # 完了済みの Future ではコールバックがその場で呼ばれるので、ロックの外で登録する
+            future.add_done_callback(lambda done: self._forget(key, done))
+        return key, future
+
+    def generate(self, prompt, model=SCENARIO_MODEL, timeout=None):
+        """生成結果を待って返す。失敗したときは例外を送出する"""
+        key, future = self.submit(prompt, model)
+        if future is None:
+            scenario = _cache().get(_result_key(key))
+            if scenario is not None:
+                return scenario
+            # 確認した直後に期限切れになった場合はもう一度依頼する
+            key, future = self.submit(prompt, model)
+            if future is None:
+                return _cache().get(_result_key(key))
+        return future.result(timeout=timeout)
+
+    def status(self, key):
+        """(状態, シナリオまたはエラーメッセージ) を返す"""
+        scenario = _cache().get(_result_key(key))
+        if scenario is not None:
+            return DONE, scenario
+        with self._lock:
+            if key in self._inflight:
+                return PENDING, None
+        if _cache().get(_pending_key(key)) is not None:
+            return PENDING, None
+        error = _cache().get(_error_key(key))
+        if error is not None:
+            return FAILED, error
+        return UNKNOWN, None
+
+
+jobs = ScenarioJobs()
@@ -0,0 +1,90 @@
+"""性能テスト・負荷試験用のデータ投入
+
+グループ数 × 日数 × 授業時間分の5分ごとのセグメントを Data に一括登録し、
+グループ・日ごとの集計（GroupSessionRollup）も作り直す。
+"""
+import contextlib
+import datetime
+import random
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import rollups
+from .models import Data
+
+SEGMENT_MINUTES = 5
+# 5分間の文字起こしとしておおよそ妥当な長さ（話者分離済みの形式）
+UTTERANCES = [
+    "それでは今日の課題について意見を出していきましょう。",
+    "私はまず前提条件を整理した方がいいと思います。",
+    "資料の3ページ目にある図がヒントになりそうです。",
+    "なるほど、その考え方だと結論が変わってきますね。",
+    "時間が限られているので役割分担を決めませんか。",
+    "少し別の視点から見ると、コストの問題もあります。",
+]
+
+
+@contextlib.contextmanager
+def explicit_datetime():
+    """Data.datetime の auto_now_add を一時的に止め、指定した日時で登録できるようにする"""
+    field = Data._meta.get_field('datetime')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+def make_transcript(rng, utterances):
+    lines = []
+    for i in range(utterances):
+        lines.append(f"話者{'ABCD'[i % 4]}: {rng.choice(UTTERANCES)}")
+    return "\n".join(lines)
+
+
+def iter_records(groups, days, hours_per_day, start=None, seed=0):
+    """登録する Data を古い順に返す（まだ保存しない）"""
+    rng = random.Random(seed)
+    if start is None:
+        # 昨日を最終日とし（今日の書き込みと時刻が前後しないように）、9時から授業が始まるものとする
+        today = timezone.localdate()
+        start = timezone.make_aware(datetime.datetime.combine(
+            today - datetime.timedelta(days=days), datetime.time(9)))
+    segments_per_day = hours_per_day * 60 // SEGMENT_MINUTES
+    for day in range(days):
+        day_start = start + datetime.timedelta(days=day)
+        for segment in range(segments_per_day):
+            at = day_start + datetime.timedelta(minutes=segment * SEGMENT_MINUTES)
+            for group in range(groups):
+                utterances = rng.randint(0, 40)
+                transcript = make_transcript(rng, utterances)
+                yield Data(
+                    group_id=f"G{group + 1:02d}",
+                    transcript=transcript.replace("\n", " "),
+                    transcript_diarize=transcript,
+                    utterance_count=utterances,
+                    sentiment_value=round(rng.uniform(-1, 1), 3),
+                    datetime=at,
+                )
+
+
+def seed_data(groups=8, days=5, hours_per_day=6, start=None, seed=0, batch_size=1000):
+    """データを投入して登録件数を返す"""
+    count = 0
+    keys = set()
+    batch = []
+    with explicit_datetime(), transaction.atomic():
+        for record in iter_records(groups, days, hours_per_day, start, seed):
+            batch.append(record)
+            keys.add((record.group_id, rollups.session_date(record.datetime)))
+            if len(batch) >= batch_size:
+                Data.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            Data.objects.bulk_create(batch)
+            count += len(batch)
+        for group_id, date in sorted(keys):
+            rollups.recompute(group_id, date)
+    return count
@@ -1,6 +1,8 @@
 from rest_framework import serializers
-from .models import Data
+from .models import Data, GroupSessionRollup
+from django.db import transaction
 from django.utils import timezone
+from . import cache, rollups
 
 class DataSerializer(serializers.ModelSerializer):
     datetime = serializers.DateTimeField(read_only=True)
@@ -11,4 +13,37 @@ class DataSerializer(serializers.ModelSerializer):
         
     def create(self, validated_data):
         validated_data['datetime'] = timezone.now()
-        return super().create(validated_data)
\ No newline at end of file
+        with transaction.atomic():
+            instance = super().create(validated_data)
+            rollups.record_created(instance)
+        cache.invalidate([instance.group_id], [instance.pk])
+        return instance
+
+    def update(self, instance, validated_data):
+        # group_id が変わる場合は変更前のグループのキャッシュ・集計も更新する
+        old_group_id = instance.group_id
+        with transaction.atomic():
+            instance = super().update(instance, validated_data)
+            date = rollups.session_date(instance.datetime)
+            for group_id in sorted({old_group_id, instance.group_id}):
+                rollups.recompute(group_id, date)
+        cache.invalidate([old_group_id, instance.group_id], [instance.pk])
+        return instance
+
+
+class DataSummarySerializer(serializers.ModelSerializer):
+    """グラフ描画用の軽量表現。文字起こし（transcript, transcript_diarize）は含めない"""
+
+    class Meta:
+        model = Data
+        fields = ['id', 'group_id', 'utterance_count', 'sentiment_value', 'datetime']
+        read_only_fields = fields
+
+
+class GroupSessionRollupSerializer(serializers.ModelSerializer):
+    sentiment_avg = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = GroupSessionRollup
+        fields = ['group_id', 'session_date', 'segment_count', 'utterance_sum', 'sentiment_avg',
+                  'sentiment_min', 'sentiment_max', 'first_datetime', 'last_datetime']
\ No newline at end of file
@@ -1,3 +1,471 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import threading
+import warnings
+from unittest import mock
 
-# Create your tests here.
+from django.core.asgi import get_asgi_application
+from django.core.cache import CacheKeyWarning, caches
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import cache, checks, scenario, seeding, views
+from .openai_stub import FakeAsyncOpenAI, FakeOpenAI
+from .models import Data, GroupSessionRollup
+
+# 性能テスト用のデータ量（8グループ × 5日 × 6時間分の5分セグメント = 2880行）
+GROUPS = 8
+DAYS = 5
+HOURS_PER_DAY = 6
+
+
+class ApiTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.row_count = seeding.seed_data(groups=GROUPS, days=DAYS, hours_per_day=HOURS_PER_DAY)
+        cls.first = Data.objects.order_by('id').first()
+
+    def setUp(self):
+        caches[cache.DATA_CACHE_ALIAS].clear()
+        caches[scenario.SCENARIO_CACHE_ALIAS].clear()
+        self.client = APIClient()
+        self.openai = FakeOpenAI()
+        patcher = mock.patch.object(scenario, 'client', self.openai)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def last_day(self):
+        # 投入したデータの最終日（昨日）
+        return timezone.localdate() - datetime.timedelta(days=1)
+
+    def last_day_range(self):
+        start = timezone.make_aware(datetime.datetime.combine(self.last_day(), datetime.time.min))
+        return start.isoformat(), (start + datetime.timedelta(days=1)).isoformat()
+
+
+class QueryBudgetTests(ApiTestCase):
+    """エンドポイントごとの SQL 発行数の上限（N+1 や余分な問い合わせを検出する）"""
+
+    def test_seeded_volume(self):
+        self.assertEqual(self.row_count, GROUPS * DAYS * HOURS_PER_DAY * 12)
+        self.assertEqual(GroupSessionRollup.objects.count(), GROUPS * DAYS)
+
+    def test_list_is_one_query_regardless_of_page_size(self):
+        for page_size in (10, 500):
+            caches[cache.DATA_CACHE_ALIAS].clear()
+            with self.assertNumQueries(1):
+                response = self.client.get('/api/data/', {'page_size': page_size})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()['results']), page_size)
+
+    def test_list_next_page_is_one_query(self):
+        response = self.client.get('/api/data/', {'page_size': 100})
+        with self.assertNumQueries(1):
+            response = self.client.get(response.json()['next'])
+        self.assertEqual(len(response.json()['results']), 100)
+
+    def test_filter_by_group_and_datetime_is_one_query(self):
+        after, before = self.last_day_range()
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/data/', {
+                'group_id': 'G01', 'datetime_after': after, 'datetime_before': before, 'page_size': 1000,
+            })
+        results = response.json()['results']
+        self.assertEqual(len(results), HOURS_PER_DAY * 12)
+        self.assertTrue(all(row['group_id'] == 'G01' for row in results))
+
+    def test_search_is_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/data/', {'search': 'g02'})
+        self.assertTrue(all(row['group_id'] == 'G02' for row in response.json()['results']))
+
+    def test_empty_result_is_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/data/', {'group_id': 'NONE'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_summary_view_does_not_load_transcripts(self):
+        with self.assertNumQueries(1) as captured:
+            response = self.client.get('/api/data/', {'view': 'summary'})
+        self.assertNotIn('transcript', captured.captured_queries[0]['sql'])
+        self.assertNotIn('transcript', response.json()['results'][0])
+
+    def test_retrieve_is_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/data/{self.first.id}/')
+        self.assertEqual(response.json()['id'], self.first.id)
+
+    def test_cached_polls_issue_no_queries(self):
+        self.client.get('/api/data/', {'group_id': 'G03'})
+        self.client.get(f'/api/data/{self.first.id}/')
+        with self.assertNumQueries(0):
+            self.client.get('/api/data/', {'group_id': 'G03'})
+            self.client.get(f'/api/data/{self.first.id}/')
+
+    def test_cache_keys_are_safe_for_any_group_id(self):
+        # 空白や長い値をそのままキーに入れると Memcached では使えない（LocMemCache は警告を出す）
+        Data.objects.create(group_id='G 1', utterance_count=1, sentiment_value=0)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', CacheKeyWarning)
+            self.client.get('/api/data/', {'group_id': 'G' * 300})
+            self.client.get('/api/data/', {'group_id': 'G 1'})
+            with self.assertNumQueries(0):
+                response = self.client.get('/api/data/', {'group_id': 'G 1'})
+        self.assertEqual(len(response.json()['results']), 1)
+
+    def test_write_invalidates_only_its_group(self):
+        self.client.get('/api/data/', {'group_id': 'G03'})
+        self.client.get('/api/data/', {'group_id': 'G04'})
+        # キャッシュの無効化はコミット後に行われる
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/data/', {'group_id': 'G03', 'utterance_count': 1, 'sentiment_value': 0},
+                             format='json')
+        with self.assertNumQueries(0):
+            self.client.get('/api/data/', {'group_id': 'G04'})
+        with self.assertNumQueries(1):
+            self.client.get('/api/data/', {'group_id': 'G03'})
+
+    def test_differently_spelled_urls_are_invalidated(self):
+        # 0 埋めの主キーや空白付きの検索語でも、書き込みで無効化されるキーを使う
+        detail = f'/api/data/0{self.first.id}/'
+        self.client.get(detail)
+        self.client.get('/api/data/', {'search': ' G03'})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/data/{self.first.id}/', {'utterance_count': 99}, format='json')
+            self.client.post('/api/data/', {'group_id': 'G03', 'utterance_count': 1, 'sentiment_value': 0},
+                             format='json')
+        self.assertEqual(self.client.get(detail).json()['utterance_count'], 99)
+        with self.assertNumQueries(1):
+            self.client.get('/api/data/', {'search': ' G03'})
+
+    def test_changes_and_not_modified(self):
+        latest = Data.objects.order_by('-id').first().id
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/data/changes/', {'since': latest - 5})
+        self.assertEqual(len(response.json()['results']), 5)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/data/changes/', {'since': latest - 5},
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_aggregate_is_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/data/aggregate/', {'interval': 'day'})
+        results = response.json()['results']
+        self.assertEqual(len(results), GROUPS * DAYS)
+        self.assertEqual(sum(row['segment_count'] for row in results), self.row_count)
+
+    def test_aggregate_minute_buckets_are_bounded(self):
+        after, before = self.last_day_range()
+        params = {'datetime_after': after, 'datetime_before': before}
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/data/aggregate/', params)
+        body = response.json()
+        self.assertEqual(body['interval'], '15min')
+        # 5分セグメントが3本ずつ 15 分の区間にまとまる
+        self.assertEqual(len(body['results']), GROUPS * HOURS_PER_DAY * 4)
+        self.assertEqual({row['segment_count'] for row in body['results']}, {3})
+        minutes = {datetime.datetime.fromisoformat(row['bucket']).minute for row in body['results']}
+        self.assertEqual(minutes, {0, 15, 30, 45})
+
+        with mock.patch('ta_support_app.views.AGGREGATE_MAX_BUCKETS', 100):
+            response = self.client.get('/api/data/aggregate/', {**params, 'interval': '5min'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rollups_is_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/rollups/', {'session_date': self.last_day().isoformat()})
+        self.assertEqual(len(response.json()), GROUPS)
+
+    def test_export_reads_in_bounded_chunks(self):
+        after, before = self.last_day_range()
+        params = {'datetime_after': after, 'datetime_before': before}
+        rows = GROUPS * HOURS_PER_DAY * 12
+        with mock.patch('ta_support_app.views.EXPORT_CHUNK_SIZE', 100):
+            with self.assertNumQueries(rows // 100 + 1):
+                response = self.client.get('/api/data/export/', params)
+                lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), rows)
+
+    def test_bulk_is_bounded_by_groups_not_rows(self):
+        records = [
+            {'group_id': f'G0{i % 2 + 1}', 'utterance_count': 1, 'sentiment_value': 0.5}
+            for i in range(100)
+        ]
+        # 冪等キーの確認・登録、INSERT とセーブポイントで5回、新しいグループ・日の集計の作成はそれぞれ7回
+        with self.assertNumQueries(5 + 7 * 2):
+            response = self.client.post('/api/data/bulk/', records, format='json', HTTP_IDEMPOTENCY_KEY='batch-1')
+        self.assertEqual(response.status_code, 201)
+        with self.assertNumQueries(1):
+            response = self.client.post('/api/data/bulk/', records, format='json', HTTP_IDEMPOTENCY_KEY='batch-1')
+        self.assertTrue(response.json()['replayed'])
+
+
+class RollupTests(ApiTestCase):
+    def assertRollupMatchesData(self, group_id):
+        date = timezone.localdate()
+        rows = Data.objects.filter(group_id=group_id, datetime__date=date)
+        rollup = GroupSessionRollup.objects.filter(group_id=group_id, session_date=date).first()
+        if not rows:
+            # 行がなくなったグループ・日の集計は削除される
+            self.assertIsNone(rollup)
+            return
+        self.assertEqual(rollup.segment_count, rows.count())
+        self.assertEqual(rollup.utterance_sum, sum(row.utterance_count for row in rows))
+
+    def test_create_update_delete_keep_rollups_in_sync(self):
+        response = self.client.post('/api/data/', {'group_id': 'G01', 'utterance_count': 7, 'sentiment_value': 0.1},
+                                    format='json')
+        record_id = response.json()['id']
+        self.assertRollupMatchesData('G01')
+        self.client.patch(f'/api/data/{record_id}/', {'group_id': 'G02', 'utterance_count': 9}, format='json')
+        self.assertRollupMatchesData('G01')
+        self.assertRollupMatchesData('G02')
+        self.client.delete(f'/api/data/{record_id}/')
+        self.assertRollupMatchesData('G02')
+
+
+class ScenarioTests(ApiTestCase):
+    """generate_scenario は OpenAI の代わりに FakeOpenAI を使って確認する"""
+
+    def test_identical_requests_call_upstream_once(self):
+        for _ in range(3):
+            response = self.client.post('/api/data/generate_scenario/', {'transcript': '議論の内容'}, format='json')
+            self.assertEqual(response.json()['scenario'], self.openai.text)
+        self.assertEqual(len(self.openai.prompts), 1)
+
+    def test_posted_transcript_is_truncated(self):
+        self.client.post('/api/data/generate_scenario/', {'transcript': 'あ' * 100000}, format='json')
+        self.assertLess(len(self.openai.prompts[0]), scenario.SCENARIO_MAX_TRANSCRIPT_CHARS + 1000)
+
+    def summary_calls(self):
+        return [prompt for prompt in self.openai.prompts if prompt.startswith(scenario.SUMMARY_PROMPT_HEADER)]
+
+    def add_segments(self, group_id, count):
+        last = Data.objects.filter(group_id=group_id).order_by('-datetime').first()
+        with seeding.explicit_datetime():
+            for i in range(1, count + 1):
+                Data.objects.create(group_id=group_id, utterance_count=1, sentiment_value=0,
+                                    transcript_diarize='話者A: 追加',
+                                    datetime=last.datetime + datetime.timedelta(minutes=seeding.SEGMENT_MINUTES * i))
+
+    def test_group_prompt_queries_and_calls_are_bounded(self):
+        after, _ = self.last_day_range()
+        params = {'group_id': 'G01', 'datetime_after': after}
+        # 行IDの一覧・要約する区切りの行（まとめて1回）・直近の行
+        with self.assertNumQueries(3):
+            response = self.client.post('/api/data/generate_scenario/', params, format='json')
+        self.assertEqual(response.status_code, 200)
+        # キャッシュが空でも、要約の呼び出しは区切りの数によらず上限まで
+        self.assertEqual(len(self.summary_calls()), scenario.SCENARIO_MAX_SUMMARY_CHUNKS)
+        self.assertEqual(len(self.openai.prompts), scenario.SCENARIO_MAX_SUMMARY_CHUNKS + 1)
+
+        # 区切りが埋まるまでは要約を作らず、行の読み込みも2回で済む
+        self.add_segments('G01', 1)
+        with self.assertNumQueries(2):
+            self.client.post('/api/data/generate_scenario/', params, format='json')
+        self.assertEqual(len(self.summary_calls()), scenario.SCENARIO_MAX_SUMMARY_CHUNKS)
+
+        # 区切りが1つ埋まると、要約はキャッシュ済みのものに1回だけ積み重ねる
+        self.add_segments('G01', scenario.SCENARIO_SUMMARY_MINUTES // seeding.SEGMENT_MINUTES)
+        self.client.post('/api/data/generate_scenario/', params, format='json')
+        self.assertEqual(len(self.summary_calls()), scenario.SCENARIO_MAX_SUMMARY_CHUNKS + 1)
+        self.assertLess(len(self.openai.prompts[-1]), scenario.SCENARIO_MAX_TRANSCRIPT_CHARS + 3000)
+
+    def test_group_prompt_defaults_to_today(self):
+        # 投入したデータは昨日までなので、範囲を指定しなければ該当なし
+        response = self.client.post('/api/data/generate_scenario/', {'group_id': 'G01'}, format='json')
+        self.assertEqual(response.status_code, 404)
+        Data.objects.create(group_id='G01', utterance_count=1, sentiment_value=0, transcript_diarize='話者A: 今日')
+        prompt = scenario.load_group_prompt('G01')
+        self.assertEqual(prompt.chunks, [])
+        self.assertIn('話者A: 今日', prompt.recent)
+        self.assertEqual(prompt.recent.count('話者'), 1)
+
+    def test_moving_datetime_after_within_a_slot_keeps_summaries(self):
+        after, _ = self.last_day_range()
+        start = datetime.datetime.fromisoformat(after) + datetime.timedelta(hours=9)
+        for minutes in (0, 1, scenario.SCENARIO_SUMMARY_MINUTES - 1):
+            self.client.post('/api/data/generate_scenario/',
+                             {'group_id': 'G01', 'datetime_after': (start + datetime.timedelta(minutes=minutes)).isoformat()},
+                             format='json')
+        self.assertEqual(len(self.summary_calls()), scenario.SCENARIO_MAX_SUMMARY_CHUNKS)
+
+    def test_summary_keys_are_safe_for_any_group_id(self):
+        after, _ = self.last_day_range()
+        Data.objects.filter(group_id='G03').update(group_id='G 3')
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', CacheKeyWarning)
+            response = self.client.post('/api/data/generate_scenario/', {'group_id': 'G 3', 'datetime_after': after},
+                                        format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(self.summary_calls())
+
+    def test_invalid_datetime_is_rejected(self):
+        for value in ('2025-02-30T10:00:00', 20250101, 'yesterday'):
+            with self.subTest(value=value):
+                response = self.client.post('/api/data/generate_scenario/',
+                                            {'group_id': 'G01', 'datetime_after': value}, format='json')
+                self.assertEqual(response.status_code, 400)
+
+    def wait_for_job(self, job_id):
+        for _ in range(500):
+            state, value = scenario.jobs.status(job_id)
+            if state != scenario.PENDING:
+                return state, value
+            threading.Event().wait(0.01)
+        self.fail('job did not finish')
+
+    def test_group_summaries_run_in_the_job(self):
+        after, _ = self.last_day_range()
+        threads = []
+
+        def complete(prompt, model=scenario.SCENARIO_MODEL):
+            threads.append(threading.current_thread().name)
+            return '要約'
+
+        with mock.patch.object(scenario, 'complete', complete):
+            response = self.client.post('/api/data/generate_scenario/',
+                                        {'group_id': 'G01', 'datetime_after': after, 'async': True}, format='json')
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(self.wait_for_job(response.json()['job_id'])[0], scenario.DONE)
+        self.assertEqual(len(threads), scenario.SCENARIO_MAX_SUMMARY_CHUNKS + 1)
+        self.assertTrue(all(name.startswith('scenario') for name in threads), threads)
+
+    def test_concurrent_group_prompts_share_summaries(self):
+        after, _ = self.last_day_range()
+        prompts = [scenario.load_group_prompt('G02', datetime.datetime.fromisoformat(after)) for _ in range(2)]
+        calls = []
+
+        def complete(prompt, model=scenario.SCENARIO_MODEL):
+            calls.append(prompt)
+            threading.Event().wait(0.005)
+            return '要約'
+
+        with mock.patch.object(scenario, 'complete', complete):
+            threads = [threading.Thread(target=prompt.build) for prompt in prompts]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+        self.assertEqual(len(calls), len(prompts[0].chunks))
+
+    def test_async_job_can_be_polled(self):
+        response = self.client.post('/api/data/generate_scenario/', {'transcript': '非同期', 'async': True},
+                                    format='json')
+        job_id = response.json()['job_id']
+        scenario.jobs.generate(scenario.build_prompt('非同期'))
+        response = self.client.get(f'/api/data/generate_scenario/{job_id}/')
+        self.assertEqual(response.json()['status'], scenario.DONE)
+
+    def test_pending_job_is_visible_to_other_processes(self):
+        release = threading.Event()
+        with mock.patch.object(scenario, 'complete', side_effect=lambda prompt, model: release.wait(5) and '結果'):
+            key, future = scenario.jobs.submit('別プロセスから確認')
+            # 別のワーカープロセスはプロセス内の生成中ジョブを知らない
+            other_process = scenario.ScenarioJobs(max_workers=1)
+            self.assertEqual(other_process.status(key), (scenario.PENDING, None))
+            release.set()
+            future.result(timeout=5)
+        self.assertEqual(other_process.status(key), (scenario.DONE, '結果'))
+
+    def test_stream_closes_upstream_when_client_disconnects(self):
+        response = self.client.post('/api/data/generate_scenario/stream/', {'transcript': '途中で切断'},
+                                    format='json')
+        events = iter(response.streaming_content)
+        self.assertIn(b'event: delta', next(events))
+        response.close()
+        self.assertEqual(self.openai.closed, 1)
+
+
+class SystemCheckTests(SimpleTestCase):
+    def test_warns_about_process_local_caches(self):
+        locmem = {'default': {'BACKEND': checks.LOCMEM_BACKEND}}
+        with override_settings(CACHES=locmem):
+            self.assertEqual([w.id for w in checks.check_shared_caches(None)],
+                             ['ta_support_app.W001', 'ta_support_app.W002'])
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://'}}
+        with override_settings(CACHES=shared):
+            self.assertEqual(checks.check_shared_caches(None), [])
+
+
+class AsgiRequest:
+    """get_asgi_application() に1件のリクエストを送る。sent に送信されたメッセージが届く
+
+    sent は1件ずつしか溜めないので、テスト側が受け取るまでアプリケーションの送信は待たされる。
+    """
+
+    def __init__(self, method, path, body=b'', query_string=b'', headers=()):
+        self.scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+            'scheme': 'http', 'path': path, 'raw_path': b'', 'query_string': query_string,
+            'headers': [(b'host', b'testserver'), (b'content-length', str(len(body)).encode()), *headers],
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        }
+        self.requests = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        self.disconnected = asyncio.Event()
+        self.sent = asyncio.Queue(maxsize=1)
+        self.task = asyncio.create_task(get_asgi_application()(self.scope, self.receive, self.sent.put))
+
+    async def receive(self):
+        if self.requests:
+            return self.requests.pop(0)
+        await self.disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def next_message(self):
+        return await asyncio.wait_for(self.sent.get(), 5)
+
+
+class AsgiExportTests(ApiTestCase):
+    async def test_export_is_streamed_chunk_by_chunk(self):
+        after, before = self.last_day_range()
+        query = f'datetime_after={after}&datetime_before={before}'.replace('+', '%2B').encode()
+        rows = GROUPS * HOURS_PER_DAY * 12
+        export_chunk = views.DataViewSet._export_chunk
+        with mock.patch('ta_support_app.views.EXPORT_CHUNK_SIZE', 100), \
+                mock.patch.object(views.DataViewSet, '_export_chunk', autospec=True,
+                                  side_effect=export_chunk) as reads:
+            request = AsgiRequest('GET', '/api/data/export/', query_string=query)
+            start = await request.next_message()
+            self.assertEqual(start['status'], 200)
+            bodies = [(await request.next_message())['body']]
+            # 最初の行が届いた時点では、まだ全体を読み込んでいない
+            self.assertLess(reads.call_count, rows // 100 + 1)
+            while True:
+                message = await request.next_message()
+                bodies.append(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            await asyncio.wait_for(request.task, 5)
+        self.assertEqual(len(b''.join(bodies).splitlines()), rows)
+        self.assertEqual(reads.call_count, rows // 100 + 1)
+
+
+class AsgiStreamTests(SimpleTestCase):
+    """ASGI で動かしたときも generate_scenario/stream が少しずつ送られ、切断で上流が閉じられる"""
+
+    def setUp(self):
+        caches[scenario.SCENARIO_CACHE_ALIAS].clear()
+        self.openai = FakeAsyncOpenAI()
+        patcher = mock.patch.object(scenario, 'async_client', self.openai)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_stream_is_sent_incrementally_and_closed_on_disconnect(self):
+        body = json.dumps({'transcript': 'ASGIで配信'}).encode('utf-8')
+        request = AsgiRequest('POST', '/api/data/generate_scenario/stream/', body,
+                              headers=[(b'content-type', b'application/json'), (b'accept', b'text/event-stream')])
+
+        start = await request.next_message()
+        self.assertEqual((start['type'], start['status']), ('http.response.start', 200))
+        # 上流のストリームが終わる前に最初のトークンが届く
+        first = await request.next_message()
+        self.assertIn(b'event: delta', first['body'])
+        self.assertEqual(self.openai.closed, 0)
+
+        request.disconnected.set()
+        await asyncio.wait_for(request.task, 5)
+        self.assertEqual(self.openai.closed, 1)
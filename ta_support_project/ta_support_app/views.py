@@ -1,52 +1,463 @@
+import datetime
+import logging
 from rest_framework import viewsets, filters, status
 from rest_framework.decorators import action
-from .models import Data
-from .serializers import DataSerializer
+from .models import Data, GroupSessionRollup, IngestBatch
+from .serializers import DataSerializer, DataSummarySerializer, GroupSessionRollupSerializer
 from django_filters.rest_framework import DjangoFilterBackend
 from .filters import DataFilter
+from .pagination import DataCursorPagination
+from .renderers import CSVRenderer, EventStreamRenderer, NDJSONRenderer, csv_line, ndjson_line, sse_event
 from rest_framework.response import Response
+from rest_framework.renderers import JSONRenderer
 from rest_framework import status
-from openai import OpenAI
+from asgiref.sync import sync_to_async
 from django.conf import settings
-client = OpenAI(api_key=settings.OPEN_AI_API_KEY)
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.db.models import Avg, Count, Max, Min, Q, Sum
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags, quote_etag
+from django.db.models.functions import ExtractMinute, Floor, TruncDay, TruncHour, TruncMinute
+from . import cache, rollups, scenario
+
+logger = logging.getLogger(__name__)
+
+# bulk で一度に登録できる最大件数と、1回の INSERT 文にまとめる件数
+BULK_MAX_ROWS = getattr(settings, 'DATA_BULK_MAX_ROWS', 1000)
+BULK_BATCH_SIZE = getattr(settings, 'DATA_BULK_BATCH_SIZE', 200)
+
+# export で1回の問い合わせで読み込む件数（サーバのメモリ使用量はこの件数で決まる）
+EXPORT_CHUNK_SIZE = getattr(settings, 'DATA_EXPORT_CHUNK_SIZE', 500)
+EXPORT_FIELDS = ['id', 'group_id', 'datetime', 'utterance_count', 'sentiment_value', 'transcript', 'transcript_diarize']
+
+# aggregate の interval に指定できる集計単位。(切り捨て関数, 1時間を区切る分数)
+# N分単位は時で切り捨てたうえで、分を N で割った区分ごとにまとめる
+AGGREGATE_INTERVALS = {
+    'minute': (TruncMinute, None),
+    '5min': (TruncHour, 5),
+    '15min': (TruncHour, 15),
+    '30min': (TruncHour, 30),
+    'hour': (TruncHour, None),
+    'day': (TruncDay, None),
+}
+AGGREGATE_DEFAULT_INTERVAL = '15min'
+# aggregate で返す区間数の上限（グループ数 × 区間数）。超える場合は 400 を返す
+AGGREGATE_MAX_BUCKETS = getattr(settings, 'DATA_AGGREGATE_MAX_BUCKETS', 5000)
+
+
+def is_asgi(request):
+    """ASGI で処理しているリクエストか。ASGI では StreamingHttpResponse に同期イテレータを渡すと
+    Django が最後まで list() で読み切ってから送るため、少しずつ返すには非同期イテレータが要る
+    """
+    return isinstance(getattr(request, '_request', request), ASGIRequest)
+
 
 class DataViewSet(viewsets.ModelViewSet):
     queryset = Data.objects.all()
     serializer_class = DataSerializer
     filter_backends = [filters.SearchFilter, DjangoFilterBackend]
     filterset_class = DataFilter
-    search_fields = ['group_id']
+    pagination_class = DataCursorPagination
+    # '=' は完全一致（大文字小文字は区別しない）。icontains と違い group_id のインデックスを使える
+    search_fields = ['=group_id']
+
+    def is_summary_view(self):
+        # 一覧取得で ?view=summary が指定されたときは文字起こしを読み込まない
+        return self.action in ('list', 'changes') and self.request.query_params.get('view') == 'summary'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.is_summary_view():
+            queryset = queryset.only(*DataSummarySerializer.Meta.fields)
+        return queryset
+
+    def get_serializer_class(self):
+        if self.is_summary_view():
+            return DataSummarySerializer
+        return super().get_serializer_class()
 
     def list(self, request, *args, **kwargs):
-        queryset = self.filter_queryset(self.get_queryset())
+        # 同じ URL へのポーリングはキャッシュから返す（書き込み時にグループ単位で無効化）
+        key = cache.response_key(request, self._cache_group(request))
+        cached = cache.load(key)
+        if cached is not None:
+            return Response(cached)
+
+        response = self._list(request)
+        if response.status_code == status.HTTP_200_OK:
+            cache.store(key, response.data)
+        return response
 
-        if not queryset.exists():
-            return Response({"Error": "一致する検索結果がありません"}, status=status.HTTP_404_NOT_FOUND)
+    def _cache_group(self, request):
+        """一覧のキャッシュキーに含めるグループ。絞り込みと同じく前後の空白などを除いた値にする"""
+        group_id = (request.query_params.get('group_id') or '').strip()
+        if group_id:
+            return group_id
+        terms = filters.SearchFilter().get_search_terms(request)
+        # 複数の語で検索した場合は全体のバージョンを使う
+        return terms[0] if len(terms) == 1 else None
+
+    def _list(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
 
         page = self.paginate_queryset(queryset)
         if page is not None:
+            # 1ページ目が空なら該当データなし（exists() の問い合わせを別に発行しない）
+            if not page and self.paginator.cursor is None:
+                return Response({"Error": "一致する検索結果がありません"}, status=status.HTTP_404_NOT_FOUND)
             serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
 
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            # 0 埋めなど表記の違う URL でも、書き込み時に無効化される行の主キーでキーを作る
+            pk = int(kwargs[self.lookup_url_kwarg or self.lookup_field])
+        except ValueError:
+            return super().retrieve(request, *args, **kwargs)
+        key = cache.record_key(pk)
+        cached = cache.load(key)
+        if cached is not None:
+            return Response(cached)
+
+        response = super().retrieve(request, *args, **kwargs)
+        cache.store(key, response.data)
+        return response
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            super().perform_destroy(instance)
+            rollups.recompute(instance.group_id, rollups.session_date(instance.datetime))
+        cache.invalidate([instance.group_id], [instance.pk])
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """データの配列をまとめて検証し、1つのトランザクションで一括登録する
+
+        Idempotency-Key ヘッダを付けると、同じキーで再送されたバッチは登録せずに
+        前回の件数を返す（文字起こしワーカーの再送で重複しないようにするため）。
+        """
+        if not isinstance(request.data, list):
+            return Response({'error': 'A list of records is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(request.data) > BULK_MAX_ROWS:
+            return Response({'error': f'At most {BULK_MAX_ROWS} records can be sent at once.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        key = request.headers.get('Idempotency-Key')
+        if key and len(key) > IngestBatch._meta.get_field('key').max_length:
+            return Response({'error': 'Idempotency-Key is too long.'}, status=status.HTTP_400_BAD_REQUEST)
+        if key:
+            replayed = self._replayed_batch(key)
+            if replayed is not None:
+                return replayed
+
+        serializer = DataSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        now = timezone.now()
+        records = [Data(**item, datetime=now) for item in serializer.validated_data]
+
+        try:
+            with transaction.atomic():
+                if key:
+                    # 同じキーのバッチが同時に送られた場合は一意制約で後の方が失敗する
+                    IngestBatch.objects.create(key=key, row_count=len(records))
+                Data.objects.bulk_create(records, batch_size=BULK_BATCH_SIZE)
+                # 一括登録では行ごとに差分を加えず、該当するグループ・日をまとめて集計し直す
+                rollups.recompute_for(records)
+                cache.invalidate({record.group_id for record in records})
+        except IntegrityError:
+            if key:
+                replayed = self._replayed_batch(key)
+                if replayed is not None:
+                    return replayed
+            raise
+        return Response({'count': len(records), 'replayed': False}, status=status.HTTP_201_CREATED)
+
+    def _replayed_batch(self, key):
+        batch = IngestBatch.objects.filter(key=key).first()
+        if batch is None:
+            return None
+        return Response({'count': batch.row_count, 'replayed': True}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        """since で指定した id より後に追加されたデータだけを返す（ダッシュボードの差分取得用）
+
+        返した cursor を次回の since に渡すと続きから取得できる。
+        ETag は絞り込み結果の最新 id から作るので、If-None-Match が一致すれば
+        データを読み込まずに 304 を返す。
+        """
+        try:
+            since = int(request.query_params.get('since', 0))
+        except ValueError:
+            return Response({'error': 'since must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        limit = self.paginator.get_page_size(request)
+        queryset = self.filter_queryset(self.get_queryset()).filter(id__gt=since)
+
+        latest = queryset.aggregate(latest=Max('id'))['latest']
+        etag = quote_etag(f'{since}-{latest or since}')
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        rows = list(queryset.order_by('id')[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        serializer = self.get_serializer(rows, many=True)
+        return Response(
+            {
+                'cursor': rows[-1].id if rows else since,
+                'has_more': has_more,
+                'results': serializer.data,
+            },
+            headers={'ETag': etag},
+        )
+
+    @action(detail=False, methods=['get'], renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        """絞り込んだデータを NDJSON（既定）または CSV でストリーミングして返す
+
+        形式は ?format=ndjson / ?format=csv か Accept ヘッダで指定する。
+        一覧と同じ絞り込みが使える。(datetime, id) 順に EXPORT_CHUNK_SIZE 件ずつ
+        読み進めるので、期間全体を書き出してもサーバのメモリ使用量は一定になる。
+        ASGI では DB の読み込みを別スレッドで行う非同期イテレータを返し、
+        同期イテレータを Django が最後まで読み切ってから送ることのないようにする。
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        fmt = request.accepted_renderer.format
+        lines = self._aexport_lines(queryset, fmt) if is_asgi(request) else self._export_lines(queryset, fmt)
+        response = StreamingHttpResponse(lines, content_type=request.accepted_renderer.media_type)
+        response['Content-Disposition'] = f'attachment; filename="data.{fmt}"'
+        return response
+
+    def _export_chunk(self, rows, last):
+        """(datetime, id) のキーセットで last の次から EXPORT_CHUNK_SIZE 件を読み込む
+
+        MySQL のドライバは結果をすべてクライアントに読み込むため、iterator() だけでは
+        メモリ使用量が一定にならない。そこで1回の問い合わせを EXPORT_CHUNK_SIZE 件に限る。
+        """
+        if last is not None:
+            rows = rows.filter(Q(datetime__gt=last['datetime']) | Q(datetime=last['datetime'], id__gt=last['id']))
+        return list(rows[:EXPORT_CHUNK_SIZE])
+
+    def _export_line(self, row, fmt):
+        # 日時は一覧の JSON と同じくローカル時刻の ISO 8601 にする
+        record = {**row, 'datetime': timezone.localtime(row['datetime']).isoformat()}
+        if fmt == 'csv':
+            return csv_line([record[field] for field in EXPORT_FIELDS])
+        return ndjson_line(record)
+
+    def _export_lines(self, queryset, fmt):
+        rows = queryset.order_by('datetime', 'id').values(*EXPORT_FIELDS)
+        if fmt == 'csv':
+            yield csv_line(EXPORT_FIELDS)
+        last = None
+        while True:
+            chunk = self._export_chunk(rows, last)
+            for row in chunk:
+                yield self._export_line(row, fmt)
+            if len(chunk) < EXPORT_CHUNK_SIZE:
+                return
+            last = chunk[-1]
+
+    async def _aexport_lines(self, queryset, fmt):
+        rows = queryset.order_by('datetime', 'id').values(*EXPORT_FIELDS)
+        if fmt == 'csv':
+            yield csv_line(EXPORT_FIELDS)
+        last = None
+        while True:
+            chunk = await sync_to_async(self._export_chunk)(rows, last)
+            for row in chunk:
+                yield self._export_line(row, fmt)
+            if len(chunk) < EXPORT_CHUNK_SIZE:
+                return
+            last = chunk[-1]
+
+    @action(detail=False, methods=['get'])
+    def aggregate(self, request):
+        """グループごと・時間区間ごとの集計値を返す
+
+        一覧と同じ絞り込み（group_id, datetime_after, datetime_before など）が使える。
+        集計はDB側の GROUP BY で行うので、文字起こしは読み込まない。
+        interval の既定は 15min。区間数が AGGREGATE_MAX_BUCKETS を超える場合は
+        期間を絞るか粗い interval を指定するよう 400 を返す。
+        """
+        interval = request.query_params.get('interval', AGGREGATE_DEFAULT_INTERVAL)
+        if interval not in AGGREGATE_INTERVALS:
+            return Response(
+                {'error': f"interval must be one of: {', '.join(AGGREGATE_INTERVALS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        trunc, slot_minutes = AGGREGATE_INTERVALS[interval]
+
+        queryset = self.filter_queryset(self.get_queryset()).annotate(bucket=trunc('datetime'))
+        keys = ['group_id', 'bucket']
+        if slot_minutes:
+            queryset = queryset.annotate(slot=Floor(ExtractMinute('datetime') / slot_minutes))
+            keys.append('slot')
+        buckets = (
+            queryset
+            .values(*keys)
+            .annotate(
+                utterance_sum=Sum('utterance_count'),
+                sentiment_avg=Avg('sentiment_value'),
+                sentiment_min=Min('sentiment_value'),
+                sentiment_max=Max('sentiment_value'),
+                segment_count=Count('id'),
+            )
+            .order_by(*keys)
+        )
+        # 上限を超えたかどうかが分かるよう1件余分に読む
+        results = list(buckets[:AGGREGATE_MAX_BUCKETS + 1])
+        if len(results) > AGGREGATE_MAX_BUCKETS:
+            return Response(
+                {'error': f'more than {AGGREGATE_MAX_BUCKETS} buckets; '
+                          'narrow datetime_after/datetime_before or use a coarser interval'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        for row in results:
+            slot = row.pop('slot', None)
+            if slot is not None:
+                row['bucket'] += datetime.timedelta(minutes=int(slot) * slot_minutes)
+        return Response({'interval': interval, 'results': results})
+
     @action(detail=False, methods=['post'])
     def generate_scenario(self, request):
-        transcript = request.data.get('transcript')
-        if not transcript:
-            return Response({'error': 'Transcript is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        """指導シナリオを生成する
 
-        prompt = ("#命令文:\nあなたは優秀な教員です。以降に示すグループワークの内容を見て、このグループに対してどのように声を掛け指導を開始しますか？指導の際の声掛けシナリオを箇条書きで複数提示してください。その際、グループの議論を活性化させることに焦点を置いてください。\n" + "#グループワークの内容:\n" + transcript)
+        transcript の代わりに group_id（と datetime_after, datetime_before）を指定すると、
+        サーバに保存された文字起こしから直近の内容と要約でプロンプトを組み立てる。
+        datetime_after を省略した場合は当日の0時からの文字起こしを使う。
+        async に true を指定すると生成の完了を待たずに 202 とジョブIDを返す。
+        結果は generate_scenario/<job_id>/ で取得する。
+        同じ内容の依頼はキャッシュ済みの結果を返すか、生成中の依頼にまとめられる。
+        """
+        prompt, error = self._scenario_prompt(request)
+        if error is not None:
+            return error
 
+        if str(request.data.get('async', '')).lower() in ('1', 'true', 'yes'):
+            job_id, _ = scenario.jobs.submit(prompt)
+            return self._scenario_status_response(job_id)
 
         try:
-            completion = client.chat.completions.create(model='gpt-4o-mini',
-            messages=[
-                {"role": "user", "content": prompt}
-            ])
-            generated_scenario = completion.choices[0].message.content
+            generated_scenario = scenario.jobs.generate(prompt)
             return Response({'scenario': generated_scenario}, status=status.HTTP_200_OK)
         except Exception as e:
             print('Error generating scenario:', str(e))
-            return Response({'error': 'Failed to generate scenario.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+            return Response({'error': 'Failed to generate scenario.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['post'], url_path='generate_scenario/stream',
+            renderer_classes=[JSONRenderer, EventStreamRenderer])
+    def generate_scenario_stream(self, request):
+        """指導シナリオを生成しながら Server-Sent Events で少しずつ返す
+
+        生成されたテキストは delta イベント、完了時は done イベント、
+        途中で失敗したときは error イベントで通知する。
+        WSGI でも ASGI でも届いた順に送り、クライアントが切断したら上流のストリームを閉じる。
+        """
+        prompt, error = self._scenario_prompt(request)
+        if error is not None:
+            return error
+        events = self._ascenario_events(prompt) if is_asgi(request) else self._scenario_events(prompt)
+        response = StreamingHttpResponse(events, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # nginx などのプロキシでバッファリングさせない
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def _scenario_events(self, prompt):
+        tokens = scenario.stream(prompt)
+        try:
+            for delta in tokens:
+                yield sse_event({'delta': delta}, event='delta')
+        except Exception as e:
+            logger.warning('Error generating scenario: %s', e)
+            yield sse_event({'error': 'Failed to generate scenario.'}, event='error')
+            return
+        finally:
+            # クライアントが切断してこのジェネレータが閉じられた場合も上流のストリームを閉じる
+            tokens.close()
+        yield sse_event({}, event='done')
+
+    async def _ascenario_events(self, prompt):
+        tokens = scenario.astream(prompt)
+        try:
+            async for delta in tokens:
+                yield sse_event({'delta': delta}, event='delta')
+        except Exception as e:
+            logger.warning('Error generating scenario: %s', e)
+            yield sse_event({'error': 'Failed to generate scenario.'}, event='error')
+            return
+        finally:
+            # 切断時は Django がこのジェネレータを止めるので、ここで上流のストリームも閉じる
+            await tokens.aclose()
+        yield sse_event({}, event='done')
+
+    def _scenario_prompt(self, request):
+        """リクエストからプロンプト（文字列か scenario.GroupPrompt）を用意して (プロンプト, エラー時の Response) を返す"""
+        group_id = request.data.get('group_id')
+        if not group_id:
+            transcript = request.data.get('transcript')
+            if not transcript:
+                return None, Response({'error': 'Transcript is required.'}, status=status.HTTP_400_BAD_REQUEST)
+            return scenario.build_prompt(transcript), None
+
+        bounds = {}
+        for name in ('datetime_after', 'datetime_before'):
+            value = request.data.get(name)
+            if value:
+                try:
+                    # 形式は合っていても存在しない日時は ValueError、文字列以外は TypeError になる
+                    bounds[name] = parse_datetime(value)
+                except (TypeError, ValueError):
+                    bounds[name] = None
+                if bounds[name] is None:
+                    return None, Response({'error': f'{name} must be an ISO 8601 datetime.'}, status=status.HTTP_400_BAD_REQUEST)
+                if timezone.is_naive(bounds[name]):
+                    # 一覧の絞り込みと同じく、タイムゾーンのない日時はローカル時刻とみなす
+                    bounds[name] = timezone.make_aware(bounds[name])
+        try:
+            prompt = scenario.load_group_prompt(group_id, **bounds)
+        except Exception as e:
+            logger.warning('Error loading transcript: %s', e)
+            return None, Response({'error': 'Failed to generate scenario.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if prompt is None:
+            return None, Response({"Error": "一致する検索結果がありません"}, status=status.HTTP_404_NOT_FOUND)
+        return prompt, None
+
+    @action(detail=False, methods=['get'], url_path=r'generate_scenario/(?P<job_id>[0-9a-f]{64})')
+    def scenario_status(self, request, job_id=None):
+        """非同期で依頼したシナリオ生成の状態と結果を返す"""
+        return self._scenario_status_response(job_id)
+
+    def _scenario_status_response(self, job_id):
+        state, value = scenario.jobs.status(job_id)
+        if state == scenario.DONE:
+            return Response({'job_id': job_id, 'status': state, 'scenario': value}, status=status.HTTP_200_OK)
+        if state == scenario.PENDING:
+            return Response({'job_id': job_id, 'status': state}, status=status.HTTP_202_ACCEPTED)
+        if state == scenario.FAILED:
+            return Response({'job_id': job_id, 'status': state, 'error': 'Failed to generate scenario.'},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({'error': 'Unknown job.'}, status=status.HTTP_404_NOT_FOUND)
+
+
+
+class GroupSessionRollupViewSet(viewsets.ReadOnlyModelViewSet):
+    """グループ・日ごとの集計。session_date を省略すると今日の集計を返す"""
+    queryset = GroupSessionRollup.objects.order_by('session_date', 'group_id')
+    serializer_class = GroupSessionRollupSerializer
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ['group_id', 'session_date']
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list' and 'session_date' not in self.request.query_params:
+            queryset = queryset.filter(session_date=timezone.localdate())
+        return queryset
\ No newline at end of file
@@ -17,10 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework import routers
-from ta_support_app.views import DataViewSet
+from ta_support_app.views import DataViewSet, GroupSessionRollupViewSet
 
 router = routers.DefaultRouter()
 router.register(r'data', DataViewSet, basename='data')
+router.register(r'rollups', GroupSessionRollupViewSet, basename='rollups')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -0,0 +1,299 @@
+"""main.py の録音・処理部品のテスト。
+
+マイクや local_settings.py が無い環境でも実行できるよう、
+bench_pipeline.py と同じく仮の設定と pyaudio を差し込んでから読み込む。
+
+    python -m unittest test_main
+"""
+import os
+import queue
+import sys
+import tempfile
+import types
+import unittest
+import wave
+from unittest import mock
+
+import numpy as np
+from scipy.signal import resample_poly
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+WORKDIR = tempfile.mkdtemp(prefix="test-main-")
+
+
+def _import_main():
+    sys.path.insert(0, ROOT)
+    try:
+        import pyaudio  # noqa: F401
+    except ImportError:
+        fake = types.ModuleType("pyaudio")
+        fake.paInt16 = 8
+        sys.modules["pyaudio"] = fake
+    try:
+        import local_settings  # noqa: F401
+    except ImportError:
+        settings = types.ModuleType("local_settings")
+        settings.FOLDER_PATH = os.path.join(WORKDIR, "archive")
+        settings.GROUP_ID = "TEST"
+        sys.modules["local_settings"] = settings
+    cwd = os.getcwd()
+    os.chdir(WORKDIR)  # processing.log などは作業ディレクトリに出力させる
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    return main
+
+
+main = _import_main()
+
+
+class WorkdirTestCase(unittest.TestCase):
+    """各テストを空の作業ディレクトリで実行する（セグメントは相対パスで書き出されるため）。"""
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+
+def _read_pcm(path):
+    with wave.open(path, "rb") as w:
+        return np.frombuffer(w.readframes(w.getnframes()), dtype="<i2")
+
+
+class SegmentRotatorTests(WorkdirTestCase):
+    RATE = 100
+
+    def _record(self, total_frames, chunk_frames, segment_seconds, overlap_seconds=0.0):
+        finished = []
+        rotator = main.SegmentRotator(finished.append, 1, 2, self.RATE, segment_seconds,
+                                      overlap_seconds=overlap_seconds)
+        pcm = np.arange(total_frames, dtype="<i2")
+        for start in range(0, total_frames, chunk_frames):
+            rotator.feed(pcm[start:start + chunk_frames].tobytes())
+        rotator.close()
+        return pcm, [_read_pcm(path) for path in finished]
+
+    def test_segments_concatenate_to_input(self):
+        for chunk in (1, 7, 100, 333):
+            with self.subTest(chunk=chunk):
+                pcm, segments = self._record(1050, chunk, segment_seconds=3)
+                self.assertEqual([len(s) for s in segments], [300, 300, 300, 150])
+                np.testing.assert_array_equal(np.concatenate(segments), pcm)
+
+    def test_overlap_repeats_tail_without_gaps(self):
+        for chunk in (1, 13, 250):
+            with self.subTest(chunk=chunk):
+                pcm, segments = self._record(1000, chunk, segment_seconds=3, overlap_seconds=0.5)
+                # 境界は 300 フレームごとのまま、2本目以降は境界の 50 フレーム手前から始まる
+                self.assertEqual([len(s) for s in segments], [300, 350, 350, 150])
+                for i, segment in enumerate(segments):
+                    start = max(0, i * 300 - 50)
+                    np.testing.assert_array_equal(segment, pcm[start:(i + 1) * 300])
+
+    def test_wallclock_boundaries_follow_clock(self):
+        # サウンドカードのクロックが1%速く、60区間で0.6秒（60フレーム）ずれる状況
+        fast = self.RATE * 1.01
+        t0 = 1000.5
+        chunk = 10
+        ends = []
+        received = [0]
+        with mock.patch.object(main.time, "time", lambda: t0 + received[0] / fast):
+            rotator = main.SegmentRotator(lambda path: ends.append(rotator.pos), 1, 2, self.RATE, 3,
+                                          mode="wallclock")
+            for _ in range(0, 60 * 300, chunk):
+                received[0] += chunk
+                rotator.feed(b"\x00\x00" * chunk)
+        self.assertGreater(len(ends), 50)
+        for end in ends:
+            offset = (t0 + end / fast) % 3
+            self.assertLess(min(offset, 3 - offset), 2 * chunk / self.RATE)
+
+    def test_close_discards_empty_segment(self):
+        pcm, segments = self._record(300, 100, segment_seconds=3)
+        self.assertEqual(len(segments), 1)
+        self.assertFalse([p for p in os.listdir(".") if p.endswith(main.PARTIAL_SUFFIX)])
+
+    def test_rejects_overlap_not_shorter_than_segment(self):
+        with self.assertRaises(ValueError):
+            main.SegmentRotator(lambda path: None, 1, 2, self.RATE, 1, overlap_seconds=1)
+
+
+class UploadSpoolTests(WorkdirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.spool = main.UploadSpool("spool.sqlite3", base_delay=1.0, max_delay=4.0, max_attempts=3)
+
+    def _state(self, job_id):
+        return self.spool.get(job_id)["state"]
+
+    def test_claim_only_once(self):
+        job_id = self.spool.add("a.wav", "G1")
+        self.assertTrue(self.spool.claim(job_id))
+        self.assertFalse(self.spool.claim(job_id))
+        self.assertEqual(self._state(job_id), "running")
+
+    def test_failed_job_is_requeued_after_backoff(self):
+        job_id = self.spool.add("a.wav", "G1")
+        self.spool.claim(job_id)
+        delay = self.spool.mark_failed(job_id, "boom")
+        self.assertTrue(0.5 <= delay <= 1.0)
+        self.assertEqual(self.spool.claim_due(now=0), [])
+        self.assertEqual(self.spool.claim_due(now=main.time.time() + delay + 1), [job_id])
+        self.assertEqual(self._state(job_id), "queued")
+        self.assertEqual(self.spool.get(job_id)["attempts"], 1)
+
+    def test_gives_up_after_max_attempts(self):
+        job_id = self.spool.add("a.wav", "G1")
+        delays = [self.spool.mark_failed(job_id, f"error {i}") for i in range(3)]
+        self.assertIsNotNone(delays[0])
+        self.assertIsNotNone(delays[1])
+        self.assertIsNone(delays[2])
+        job = self.spool.get(job_id)
+        self.assertEqual((job["state"], job["attempts"], job["last_error"]), ("failed", 3, "error 2"))
+        self.assertEqual(self.spool.claim_due(now=main.time.time() + 3600), [])
+
+    def test_resume_requeues_running_jobs(self):
+        running = self.spool.add("a.wav", "G1")
+        queued = self.spool.add("b.wav", "G1")
+        done = self.spool.add("c.wav", "G1")
+        self.spool.claim(running)
+        self.spool.mark_done(done)
+        # 再起動時は同じDBを開き直す
+        spool = main.UploadSpool("spool.sqlite3")
+        self.assertEqual(spool.resume(), [running, queued])
+
+    def test_corrupt_recording_is_not_retried(self):
+        with open("broken.wav", "wb") as f:
+            f.write(b"RIFF\x00\x00")
+        job_id = self.spool.add("broken.wav", "G1")
+        q = queue.Queue()
+        q.put(job_id)
+        q.put(None)
+        main.process_data(q, self.spool)
+        job = self.spool.get(job_id)
+        self.assertEqual(job["state"], "failed")
+        self.assertEqual(job["attempts"], 0)
+        self.assertTrue(job["last_error"].startswith(("Error", "EOFError", "ValueError")))
+        self.assertTrue(os.path.exists("broken.wav"))
+
+
+class SignedUrlTests(unittest.TestCase):
+    def _url(self, signed_at, expires):
+        stamp = main.datetime.fromtimestamp(signed_at, main.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        return f"https://r2.example/bucket/key?X-Amz-Date={stamp}&X-Amz-Expires={expires}&X-Amz-Signature=abc"
+
+    def test_expiry_from_query(self):
+        self.assertEqual(main.signed_url_expiry(self._url(1700000000, 900)), 1700000000 + 900)
+        self.assertIsNone(main.signed_url_expiry("https://r2.example/bucket/key"))
+
+    def test_prefetched_url_is_dropped_before_it_expires(self):
+        client = main.WorkerApiClient(base_url="http://127.0.0.1:9", prefetch=1, url_ttl=300, expiry_margin=60)
+        self.addCleanup(client.close)
+        now = main.time.time()
+        fresh = self._url(now, 900)
+        stale = self._url(now - 850, 900)  # 残り50秒（余裕の60秒を下回る）
+        for url in (stale, fresh):
+            client._signed_urls.setdefault("audio/flac", main.deque()).append(
+                (client._usable_until(url), url, "key"))
+        self.assertEqual(client._take_prefetched("audio/flac"), (fresh, "key"))
+        self.assertIsNone(client._take_prefetched("audio/flac"))
+
+
+class RecoverPartialRecordingsTests(WorkdirTestCase):
+    DEVICES = [
+        {"device_index": 1, "channel": 0, "group_id": "3.B"},
+        {"device_index": 1, "channel": 1, "group_id": "4_C"},
+    ]
+
+    def _write_partial(self, group_id):
+        prefix = main._segment_prefix(group_id, True)
+        writer = main.StreamingWavWriter(f"{prefix}_20250101-100000.wav{main.PARTIAL_SUFFIX}", 1, 2, 100)
+        writer.write(b"\x01\x00" * 50)
+        writer.close()
+
+    def test_maps_file_prefix_back_to_group_id(self):
+        for entry in self.DEVICES:
+            self._write_partial(entry["group_id"])
+        recovered = []
+        main.recover_partial_recordings(lambda path, group_id: recovered.append(group_id), devices=self.DEVICES)
+        self.assertEqual(sorted(recovered), ["3.B", "4_C"])
+
+    def test_rejects_groups_with_the_same_prefix(self):
+        with self.assertRaises(ValueError):
+            main.load_device_groups([{"device_index": 1, "channel": 0, "group_id": "3.B"},
+                                     {"device_index": 1, "channel": 1, "group_id": "3_B"}])
+
+
+class SilentSegmentTests(WorkdirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.spool = main.UploadSpool("spool.sqlite3")
+        with wave.open("silent.wav", "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(16000)
+            w.writeframes(b"\x00\x00" * 16000 * 3)
+        self.job_id = self.spool.add("silent.wav", "G1")
+        archive = mock.patch.object(main, "FOLDER_PATH", os.path.join(self._tmp.name, "archive"))
+        archive.start()
+        self.addCleanup(archive.stop)
+
+    def _process(self, job_id):
+        q = queue.Queue()
+        q.put(job_id)
+        q.put(None)
+        main.process_data(q, self.spool)
+
+    def test_failed_report_is_resent_without_reprocessing(self):
+        with mock.patch.object(main, "request_transcription", side_effect=RuntimeError("503")):
+            self._process(self.job_id)
+        job = self.spool.get(self.job_id)
+        self.assertEqual((job["stage"], job["state"]), ("silent", "retry"))
+
+        self.spool.claim_due(now=main.time.time() + 3600)
+        with mock.patch.object(main, "request_transcription") as report, \
+                mock.patch.object(main, "filter_segment") as filter_segment:
+            self._process(self.job_id)
+        filter_segment.assert_not_called()
+        object_key, session_id, group_id, metadata = report.call_args.args
+        self.assertIsNone(object_key)
+        self.assertTrue(metadata["skipped"])
+        self.assertEqual(self.spool.get(self.job_id)["state"], "skipped")
+
+
+class PolyphaseResamplerTests(unittest.TestCase):
+    RATES = [(44100, 16000), (48000, 16000), (16000, 8000), (22050, 16000), (8000, 16000)]
+
+    def _resample_blocks(self, x, fs_in, fs_out, block):
+        resampler = main.PolyphaseResampler(fs_in, fs_out)
+        pieces = [resampler.process(x[i:i + block]) for i in range(0, len(x), block)]
+        pieces.append(resampler.flush())
+        return np.concatenate(pieces)
+
+    def test_matches_resample_poly(self):
+        rng = np.random.default_rng(0)
+        for fs_in, fs_out in self.RATES:
+            x = rng.normal(0, 1000, fs_in // 2 + 7)
+            g = np.gcd(fs_in, fs_out)
+            expected = resample_poly(x, fs_out // g, fs_in // g)
+            for block in (1, 97, 4096, len(x)):
+                with self.subTest(fs_in=fs_in, fs_out=fs_out, block=block):
+                    y = self._resample_blocks(x, fs_in, fs_out, block)
+                    self.assertEqual(y.shape, expected.shape)
+                    np.testing.assert_allclose(y, expected, rtol=0, atol=1e-9)
+
+    def test_multichannel_blocks(self):
+        x = np.random.default_rng(1).normal(0, 1000, (10000, 2))
+        expected = resample_poly(x, 160, 441, axis=0)
+        y = self._resample_blocks(x, 44100, 16000, 3000)
+        np.testing.assert_allclose(y, expected, rtol=0, atol=1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()